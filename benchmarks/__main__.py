@@ -0,0 +1,34 @@
+"""
+Run every offline benchmark, or the suites named on the command line
+
+    python -m benchmarks
+    python -m benchmarks sql drive --quick
+"""
+import argparse
+
+from . import bench_analytics, bench_bulk_insert, bench_drive, bench_sql
+
+SUITES = {'sql': bench_sql, 'inserts': bench_bulk_insert, 'analytics': bench_analytics, 'drive': bench_drive}
+
+# small sizes for checking the suite runs, e.g. after changing a fake
+QUICK_SIZES = {'sql': {'sizes': (1000, 10000)},
+               'inserts': {'sizes': (1000, 5000)},
+               'analytics': {'sizes': (10000, 30000)},
+               'drive': {'list_sizes': (1000,), 'file_sizes_mb': (1, 8)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('suites', nargs='*', help=f"any of {', '.join(SUITES)}, all of them if none are given")
+    parser.add_argument('--quick', action='store_true', help='use small data sizes')
+    args = parser.parse_args()
+    unknown = [name for name in args.suites if name not in SUITES]
+    if unknown:
+        parser.error(f"unknown suites {', '.join(unknown)}")
+
+    for name in args.suites or SUITES:
+        SUITES[name].main(**(QUICK_SIZES[name] if args.quick else {}))
+
+
+if __name__ == '__main__':
+    main()
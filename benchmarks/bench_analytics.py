@@ -0,0 +1,53 @@
+"""
+ga_api_caller over multi-page Reporting API v4 responses served by HttpMockSequence,
+and the report parsers on a single merged response
+
+    python -m benchmarks.bench_analytics
+"""
+from unittest import mock
+
+from database_connection import google_analytics_api_query, RequestScheduler
+from database_connection import ga_api_caller, report_to_df, metric_report_df, get_dimension_row_names
+
+from .fakes import analytics_service, ga_report_pages
+from .harness import print_header, run_case
+
+SIZES = (10000, 100000, 300000)
+PAGE_SIZE = 10000
+QUERY = {'reportRequests': [{'viewId': '0',
+                             'dateRanges': [{'startDate': '2020-01-01', 'endDate': '2020-12-31'}],
+                             'metrics': [{'expression': 'ga:sessions'}, {'expression': 'ga:users'},
+                                         {'expression': 'ga:bounceRate'}],
+                             'dimensions': [{'name': 'ga:date'}, {'name': 'ga:source'}],
+                             'pageSize': PAGE_SIZE}]}
+
+
+def main(sizes=SIZES):
+    # no rate limit, so the numbers are the client side cost of each page
+    scheduler = RequestScheduler(rate_limits={})
+
+    print_header('analytics: ga_api_caller')
+    for n_rows in sizes:
+        pages = ga_report_pages(n_rows, page_size=PAGE_SIZE)
+        service, http = analytics_service(pages)
+
+        def call():
+            http.rewind()
+            return len(ga_api_caller('key.json', QUERY, scheduler=scheduler))
+
+        with mock.patch.object(google_analytics_api_query, 'create_service', return_value=service), \
+                mock.patch.object(google_analytics_api_query, 'project_id', return_value=None):
+            run_case(f'ga_api_caller {len(pages)} pages', n_rows, call)
+
+    print_header('analytics: parsers')
+    for n_rows in sizes:
+        response = ga_report_pages(n_rows, page_size=n_rows)[0]
+        report = response['reports'][0]
+
+        run_case('report_to_df', n_rows, lambda: len(report_to_df(report)))
+        run_case('metric_report_df', n_rows, lambda: len(metric_report_df(response)))
+        run_case('get_dimension_row_names', n_rows, lambda: len(get_dimension_row_names(response)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Compare building a single INSERT string with turn_data_into_insert against the
+batched parameter path used by bulk_insert. No database is needed, the cursor
+only records what would have been sent to the server.
+
+    python -m benchmarks.bench_bulk_insert
+"""
+import numpy as np
+import pandas as pd
+
+from database_connection import turn_data_into_insert, bulk_insert
+
+from .fakes import FakeConnection
+from .harness import print_header, run_case
+
+SIZES = (1000, 10000, 50000)
+
+
+def make_dataframe(n_rows):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({'id': np.arange(n_rows),
+                         'value': rng.random(n_rows),
+                         'label': rng.choice(['alpha', 'beta', 'gamma'], n_rows),
+                         'created': pd.Timestamp('2020-01-01') + pd.to_timedelta(np.arange(n_rows), unit='s')})
+
+
+def main(sizes=SIZES):
+    print_header('sql: inserts')
+    for n_rows in sizes:
+        df = make_dataframe(n_rows)
+
+        def build_insert_string():
+            turn_data_into_insert(df, 'table', 'database')
+            return n_rows
+
+        def insert_batches():
+            return bulk_insert(FakeConnection(), df, 'database', 'table')
+
+        run_case('turn_data_into_insert', n_rows, build_insert_string, repeat=1)
+        run_case('bulk_insert', n_rows, insert_batches)
+
+
+if __name__ == '__main__':
+    main()
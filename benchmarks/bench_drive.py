@@ -0,0 +1,62 @@
+"""
+GoogleDriveService ls, download_file and upload_file against an in-memory Drive served through
+the httplib2 interface, so the numbers are the client side cost of paging, ranged downloads and uploads
+
+    python -m benchmarks.bench_drive
+"""
+import os
+import tempfile
+from unittest import mock
+
+from database_connection import GoogleDriveService, RequestScheduler
+
+from .fakes import FakeDriveHttp, drive_service
+from .harness import print_header, run_case
+
+LIST_SIZES = (1000, 10000, 50000)
+FILE_SIZES_MB = (1, 16, 64)
+FOLDER_ID = 'benchmark_folder'
+
+
+def make_drive(http):
+    """ GoogleDriveService using the fake http and no rate limit """
+    service = drive_service(http)
+    with mock.patch.object(GoogleDriveService, 'create_service', return_value=service):
+        return GoogleDriveService('client_secret.json', 'https://www.googleapis.com/auth/drive',
+                                  scheduler=RequestScheduler(rate_limits={}))
+
+
+def main(list_sizes=LIST_SIZES, file_sizes_mb=FILE_SIZES_MB):
+    print_header('drive: ls')
+    for n_files in list_sizes:
+        http = FakeDriveHttp()
+        for i in range(n_files):
+            http.add_file(f'file_{i}.csv', b'', parent=FOLDER_ID)
+        drive = make_drive(http)
+        run_case('ls', n_files, lambda: len(drive.ls(FOLDER_ID)), unit='files')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        print_header('drive: transfers')
+        for size_mb in file_sizes_mb:
+            data = os.urandom(size_mb * 1024 ** 2)
+            http = FakeDriveHttp()
+            file_id = http.add_file('data.bin', data, parent=FOLDER_ID)
+            drive = make_drive(http)
+            local_path = os.path.join(temp_dir, 'data.bin')
+            with open(local_path, 'wb') as f:
+                f.write(data)
+
+            def download():
+                return drive.download_file(file_id, os.path.join(temp_dir, 'downloaded.bin'), resume=False,
+                                           skip_unchanged=False) / 1024 ** 2
+
+            def upload():
+                drive.upload_file('data.bin', temp_dir + os.sep, FOLDER_ID)
+                return size_mb
+
+            run_case('download_file', f'{size_mb} MB', download, unit='MB')
+            run_case('upload_file', f'{size_mb} MB', upload, unit='MB')
+
+
+if __name__ == '__main__':
+    main()
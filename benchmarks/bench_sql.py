@@ -0,0 +1,79 @@
+"""
+run_sql, row_to_df, typed_row_to_df, iter_sql and the delete paths against a fake pyodbc cursor,
+so the numbers are the python side of each call without any server time
+
+    python -m benchmarks.bench_sql
+"""
+import datetime
+
+import pandas as pd
+
+from database_connection import run_sql, row_to_df, typed_row_to_df, iter_sql, delete_records, delete_by_keys
+
+from .fakes import FakeConnection, FakeCursor, RESULT_DESCRIPTION, make_rows
+from .harness import print_header, run_case
+
+SIZES = (10000, 100000, 500000)
+
+
+# SQL Server dates outside the 1677-2262 range of nanosecond timestamps, e.g. open ended validity sentinels
+WIDE_DATES = (datetime.datetime(9999, 12, 31), datetime.datetime(1, 1, 1), None)
+
+
+def check_wide_dates():
+    """ typed results keep dates pandas can't hold at nanosecond precision, in one frame and streamed in chunks """
+    rows = [(i, 0.0, 'label', created) for i, created in enumerate(WIDE_DATES)]
+    cursor = FakeCursor(rows, RESULT_DESCRIPTION)
+    result_cursor, result_rows = run_sql(cursor, query='SELECT * FROM t')
+    frames = [typed_row_to_df(result_rows, result_cursor),
+              pd.concat(iter_sql(cursor, query='SELECT * FROM t', chunk_size=1, typed=True), ignore_index=True)]
+    for df in frames:
+        assert df['created'].tolist()[:2] == list(WIDE_DATES[:2]) and pd.isna(df['created'].iloc[2]), df
+
+
+def main(sizes=SIZES):
+    check_wide_dates()
+
+    print_header('sql: fetch and build dataframes')
+    for n_rows in sizes:
+        rows = make_rows(n_rows)
+        cursor = FakeCursor(rows)
+
+        def fetch():
+            return len(run_sql(cursor, query='SELECT * FROM t')[1])
+
+        def fetch_df():
+            result_cursor, result_rows = run_sql(cursor, query='SELECT * FROM t')
+            return len(row_to_df(result_rows, result_cursor))
+
+        def fetch_typed_df():
+            result_cursor, result_rows = run_sql(cursor, query='SELECT * FROM t')
+            return len(typed_row_to_df(result_rows, result_cursor))
+
+        def stream_df():
+            return sum(len(df) for df in iter_sql(cursor, query='SELECT * FROM t'))
+
+        run_case('run_sql', n_rows, fetch)
+        run_case('run_sql + row_to_df', n_rows, fetch_df)
+        run_case('run_sql + typed_row_to_df', n_rows, fetch_typed_df)
+        run_case('iter_sql', n_rows, stream_df)
+
+    print_header('sql: deletes')
+    for n_keys in sizes:
+        keys = pd.DataFrame({'id': range(n_keys)})
+
+        def delete_in_list():
+            records = ', '.join(str(key) for key in keys['id'])
+            delete_records(FakeConnection(), FakeCursor(), 'database', 'table', 'id', records)
+            return n_keys
+
+        def delete_joined():
+            delete_by_keys(FakeConnection(), keys, 'database', 'table')
+            return n_keys
+
+        run_case('delete_records', n_keys, delete_in_list)
+        run_case('delete_by_keys', n_keys, delete_joined)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""
+Local stand-ins for SQL Server, the Reporting API v4 and Drive, so the benchmarks run without
+network access or credentials
+"""
+import datetime
+import hashlib
+import json
+import re
+import uuid
+from urllib.parse import urlparse, parse_qs
+
+import httplib2
+import numpy as np
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpMockSequence
+
+# (name, type_code, display_size, internal_size, precision, scale, null_ok) as pyodbc reports them
+RESULT_DESCRIPTION = [('id', int, None, 10, 10, 0, False),
+                      ('value', float, None, 53, 53, 0, True),
+                      ('label', str, None, 20, 20, 0, True),
+                      ('created', datetime.datetime, None, 23, 23, 3, True)]
+
+
+def make_rows(n_rows, seed=0):
+    """ result rows shaped like a pyodbc fetchall of RESULT_DESCRIPTION """
+    rng = np.random.default_rng(seed)
+    values = rng.random(n_rows).tolist()
+    labels = rng.choice(['alpha', 'beta', 'gamma'], n_rows).tolist()
+    start = datetime.datetime(2020, 1, 1)
+    return [(i, values[i], labels[i], start + datetime.timedelta(seconds=i)) for i in range(n_rows)]
+
+
+class FakeCursor:
+    """
+    pyodbc cursor stand-in. Every SELECT returns the rows it was given, everything else only records
+    what would have been sent to the server
+    """
+    fast_executemany = False
+
+    def __init__(self, rows=(), description=RESULT_DESCRIPTION):
+        self.rows = list(rows)
+        self._description = description
+        self.description = None
+        self.rowcount = -1
+        self.statements = 0
+        self.rows_sent = 0
+        self._position = 0
+
+    def execute(self, query, *params):
+        self.statements += 1
+        if query.lstrip().upper().startswith('SELECT') and ' INTO ' not in query.upper():
+            self.description = self._description
+            self._position = 0
+            self.rowcount = -1
+        else:
+            self.description = None
+            self.rowcount = self.rows_sent
+        return self
+
+    def fetchall(self):
+        rows = self.rows[self._position:]
+        self._position = len(self.rows)
+        return rows
+
+    def fetchmany(self, size):
+        rows = self.rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def setinputsizes(self, sizes):
+        self.input_sizes = sizes
+
+    def executemany(self, query, params):
+        self.statements += 1
+        self.rows_sent += len(params)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self, rows=()):
+        self.rows = rows
+        self.commits = 0
+        self.rollbacks = 0
+        self.cursors = []
+
+    def cursor(self):
+        cursor = FakeCursor(self.rows)
+        self.cursors.append(cursor)
+        return cursor
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def ga_report_pages(n_rows, page_size=10000, dimensions=('ga:date', 'ga:source'),
+                    metrics=('ga:sessions', 'ga:users', 'ga:bounceRate'), n_sources=200, seed=0):
+    """
+    Synthetic Reporting API v4 batchGet responses for one reportRequest, n_rows split over pages
+    :return: list of response dicts, each with one report and a nextPageToken on all but the last
+    """
+    rng = np.random.default_rng(seed)
+    column_header = {'dimensions': list(dimensions),
+                     'metricHeader': {'metricHeaderEntries': [{'name': name, 'type': 'INTEGER'}
+                                                              for name in metrics]}}
+    dates = [(datetime.date(2020, 1, 1) + datetime.timedelta(days=i)).strftime('%Y%m%d') for i in range(365)]
+    sources = [f'source_{i}' for i in range(n_sources)]
+    values = rng.integers(0, 10000, size=(n_rows, len(metrics)))
+
+    pages = []
+    for start in range(0, max(n_rows, 1), page_size):
+        rows = [{'dimensions': [dates[i % len(dates)], sources[i % n_sources]][:len(dimensions)],
+                 'metrics': [{'values': [str(value) for value in values[i]]}]}
+                for i in range(start, min(start + page_size, n_rows))]
+        report = {'columnHeader': column_header, 'data': {'rows': rows, 'rowCount': n_rows}}
+        if start + page_size < n_rows:
+            report['nextPageToken'] = str(start + page_size)
+        pages.append({'reports': [report]})
+    return pages
+
+
+class ReplayHttp(HttpMockSequence):
+
+    def __init__(self, responses):
+        """ HttpMockSequence which can serve its responses again after rewind, so one service is reused """
+        self.responses = responses
+        super().__init__(list(responses))
+
+    def rewind(self):
+        super().__init__(list(self.responses))
+
+
+def analytics_service(pages):
+    """
+    analyticsreporting v4 service which answers each batchGet with the next page, served through
+    an HttpMockSequence from the bundled discovery document
+    :return: (service, http), call http.rewind() before serving the pages again
+    """
+    http = ReplayHttp([({'status': '200'}, json.dumps(page)) for page in pages])
+    return build('analyticsreporting', 'v4', http=http, static_discovery=True), http
+
+
+class FakeDriveHttp:
+    """
+    In-memory Drive v3 behind the httplib2 interface googleapiclient uses. Supports files.list with
+    paging, files.get for metadata and ranged media, files.create and files.update with simple,
+    multipart and resumable uploads
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.children = {}
+        self.uploads = {}
+        self.requests = 0
+
+    def add_file(self, name, data, parent='root', mime_type='application/octet-stream'):
+        file_id = uuid.uuid4().hex
+        self._add({'id': file_id, 'name': name, 'parents': [parent], 'mimeType': mime_type}, data)
+        return file_id
+
+    def _add(self, file, data):
+        self.files[file['id']] = file
+        for parent in file['parents']:
+            self.children.setdefault(parent, []).append(file['id'])
+        self._set_data(file, data)
+
+    @staticmethod
+    def _set_data(file, data):
+        file['data'] = data
+        file['size'] = str(len(data))
+        file['md5Checksum'] = hashlib.md5(data).hexdigest()
+
+    @staticmethod
+    def _metadata(file):
+        return {key: value for key, value in file.items() if key != 'data'}
+
+    @staticmethod
+    def _json(content, status=200, headers=None):
+        return httplib2.Response(dict({'status': str(status)}, **(headers or {}))), json.dumps(content).encode()
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=1, connection_type=None):
+        self.requests += 1
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        parsed = urlparse(uri)
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        path = parsed.path
+
+        if 'upload_id' in query:
+            return self._resumable_chunk(query['upload_id'], body, headers)
+        if path.startswith('/upload/drive/v3/files'):
+            return self._start_upload(path, query, body, headers)
+
+        match = re.fullmatch(r'/drive/v3/files/([^/]+)', path)
+        if match:
+            file = self.files[match.group(1)]
+            if query.get('alt') == 'media':
+                return self._media(file, headers)
+            return self._json(self._metadata(file))
+        if path == '/drive/v3/files' and method == 'GET':
+            return self._list(query)
+        return self._json({'error': {'code': 404, 'message': f'{method} {path} is not mocked'}}, status=404)
+
+    def _list(self, query):
+        parent = re.search(r"'([^']+)' in parents", query.get('q', ''))
+        file_ids = self.children.get(parent.group(1), []) if parent else list(self.files)
+        start = int(query.get('pageToken', 0))
+        page_size = int(query.get('pageSize', 100))
+        content = {'files': [self._metadata(self.files[file_id]) for file_id in file_ids[start:start + page_size]]}
+        if start + page_size < len(file_ids):
+            content['nextPageToken'] = str(start + page_size)
+        return self._json(content)
+
+    def _media(self, file, headers):
+        data = file['data']
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+        if not match:
+            return httplib2.Response({'status': '200'}), data
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(data) - 1
+        return httplib2.Response({'status': '206'}), data[start:end + 1]
+
+    def _store(self, metadata, data, file_id=None):
+        if file_id is None:
+            file_id = uuid.uuid4().hex
+            self._add({'id': file_id, 'name': metadata.get('name'), 'parents': metadata.get('parents', ['root']),
+                       'mimeType': metadata.get('mimeType', 'application/octet-stream')}, data)
+        else:
+            self._set_data(self.files[file_id], data)
+        return self._json(self._metadata(self.files[file_id]))
+
+    def _start_upload(self, path, query, body, headers):
+        file_id = path.rsplit('/', 1)[-1] if path.count('/') > 4 else None
+        upload_type = query.get('uploadType')
+        if isinstance(body, str):
+            body = body.encode('latin-1')
+        if upload_type == 'resumable':
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = {'metadata': json.loads(body) if body else {}, 'file_id': file_id,
+                                       'data': bytearray()}
+            return self._json({}, headers={'location': f'https://www.googleapis.com{path}?uploadType=resumable'
+                                                       f'&upload_id={upload_id}'})
+        if upload_type == 'multipart':
+            # the related parts are the json metadata followed by the media, each as headers, a blank line
+            # and the content, which googleapiclient writes with \n line endings
+            boundary = re.search(r'boundary="([^"]+)"', headers['content-type']).group(1).encode()
+            _, metadata_part, media_part, _ = body.split(b'--' + boundary)
+            metadata = json.loads(metadata_part.split(b'\n\n', 1)[1])
+            return self._store(metadata, media_part.split(b'\n\n', 1)[1][:-1], file_id)
+        return self._store({}, body or b'', file_id)
+
+    def _resumable_chunk(self, upload_id, body, headers):
+        upload = self.uploads[upload_id]
+        if body:
+            upload['data'].extend(body.read() if hasattr(body, 'read') else body)
+        total = re.search(r'/(\d+|\*)$', headers.get('content-range', ''))
+        if total and total.group(1) != '*' and len(upload['data']) >= int(total.group(1)):
+            del self.uploads[upload_id]
+            return self._store(upload['metadata'], bytes(upload['data']), upload['file_id'])
+        return httplib2.Response({'status': '308', 'range': f"0-{len(upload['data']) - 1}"}), b''
+
+
+def drive_service(http):
+    """ drive v3 service object using the given http, built from the bundled discovery document """
+    return build('drive', 'v3', http=http, static_discovery=True)
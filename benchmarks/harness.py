@@ -0,0 +1,47 @@
+import gc
+import time
+import tracemalloc
+
+
+def measure(func, repeat=3):
+    """
+    Time func and find its peak python memory. The time is the best of repeat untraced runs,
+    the peak comes from one further run under tracemalloc, which slows the code it traces
+    :param func: callable taking no arguments, returns the number of items it processed
+    :param repeat: number of timed runs
+    :return: (items, seconds, peak_bytes)
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        items = func()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return items, seconds, peak_bytes
+
+
+def print_header(title):
+    print(f'\n{title}')
+    print(f"{'case':<34}{'size':>10}{'seconds':>11}{'throughput':>20}{'peak MB':>10}")
+
+
+def report(case, size, items, seconds, peak_bytes, unit='rows'):
+    throughput = f'{items / max(seconds, 1e-9):,.0f} {unit}/s'
+    print(f'{case:<34}{size:>10}{seconds:>11.4f}{throughput:>20}{peak_bytes / 1024 ** 2:>10.1f}')
+
+
+def run_case(case, size, func, unit='rows', repeat=3):
+    """
+    measure func and print a row of the results table
+    :param size: the data size being tested, shown as given
+    :param unit: what the number func returns counts, e.g. rows, pages or MB
+    """
+    report(case, size, *measure(func, repeat=repeat), unit=unit)
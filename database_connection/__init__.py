@@ -1,5 +1,12 @@
-from .sql_connection import get_connection, run_sql, run_sql_text_query, row_to_df, \
-    drop_table, delete_records, turn_data_into_insert
-from .google_analytics_api_query import ga_api_caller, pivot_report_df, metric_report_df, get_dimension_row_names, create_service
+from .sql_connection import get_connection, run_sql, run_sql_text_query, iter_sql, row_to_df, \
+    typed_row_to_df, drop_table, delete_records, turn_data_into_insert, bulk_insert, read_config, \
+    delete_by_keys, upsert_dataframe, export_query
+from .instrumentation import MetricsRegistry, set_registry, add_hook, remove_hook, export_metrics
+from .connection_pool import ConnectionPool, get_pool
+from .query_cache import QueryCache
+from .sql_template import SqlTemplate, SqlTemplateRegistry, run_sql_template
+from .google_analytics_api_query import ga_api_caller, ga_api_caller_many, report_to_df, pivot_report_df, metric_report_df, get_dimension_row_names, create_service
+from .google_api_scheduler import RequestScheduler, default_scheduler
 from .google_drive_api_service import GoogleDriveService
 from .google_analytics_service import GoogleAnalyticsService
+from .google_analytics_sync import GoogleAnalyticsSync
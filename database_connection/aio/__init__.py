@@ -0,0 +1,4 @@
+from .executors import configure, get_executor, shutdown, run_blocking, gather_limited
+from .sql import get_connection, run_sql, run_sql_text_query, run_sql_df, bulk_insert, upsert_dataframe, \
+    export_query, pooled_connection
+from .google import ga_api_caller, ga_api_caller_many, AsyncGoogleAnalyticsService, AsyncGoogleDriveService
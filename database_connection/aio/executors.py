@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# threads per kind of resource, pyodbc and googleapiclient calls block the thread they run on
+DEFAULT_WORKERS = {'sql': 8, 'analytics': 4, 'drive': 8}
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def configure(resource, max_workers):
+    """
+    Set the number of threads used for a resource. Takes effect for executors created afterwards,
+    so call it before the first async call for that resource
+    :param resource: sql, analytics or drive
+    :param max_workers: number of blocking calls run at once
+    """
+    with _executors_lock:
+        DEFAULT_WORKERS[resource] = max_workers
+        executor = _executors.pop(resource, None)
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def get_executor(resource):
+    with _executors_lock:
+        executor = _executors.get(resource)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=DEFAULT_WORKERS.get(resource, 4),
+                                          thread_name_prefix=f'adl_{resource}')
+            _executors[resource] = executor
+        return executor
+
+
+def shutdown(wait=True):
+    """ stop every executor, e.g. at the end of the orchestrator's run """
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=wait)
+
+
+async def run_blocking(resource, func, *args, timeout=None, **kwargs):
+    """
+    Run a blocking call on the resource's executor.
+    On timeout or cancellation the awaiting task stops straight away, but a call which has already started
+    carries on in its thread until it returns, as pyodbc and googleapiclient calls can't be interrupted
+    :param resource: sql, analytics or drive
+    :param func: the blocking function
+    :param timeout: seconds before asyncio.TimeoutError is raised, None to wait indefinitely
+    :return: the function's result
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_executor(resource), functools.partial(func, *args, **kwargs))
+    return await asyncio.wait_for(future, timeout)
+
+
+async def gather_limited(*awaitables, limit=None, return_exceptions=False):
+    """
+    asyncio.gather with at most limit awaitables running at once
+    :param awaitables: coroutines or futures
+    :param limit: most running at once, None for no limit
+    :param return_exceptions: passed to asyncio.gather
+    :return: list of results in the order given
+    """
+    if limit is None:
+        return await asyncio.gather(*awaitables, return_exceptions=return_exceptions)
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(awaitable):
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*[limited(awaitable) for awaitable in awaitables],
+                                return_exceptions=return_exceptions)
@@ -0,0 +1,55 @@
+from .. import google_analytics_api_query
+from ..google_analytics_reports import DEFAULT_MAX_WORKERS
+from .executors import run_blocking
+
+ANALYTICS = 'analytics'
+DRIVE = 'drive'
+
+
+async def ga_api_caller(ga_key_file, query, scheduler=None, timeout=None):
+    return await run_blocking(ANALYTICS, google_analytics_api_query.ga_api_caller, ga_key_file, query,
+                              scheduler=scheduler, timeout=timeout)
+
+
+async def ga_api_caller_many(ga_key_file, queries, max_workers=DEFAULT_MAX_WORKERS, scheduler=None, timeout=None):
+    return await run_blocking(ANALYTICS, google_analytics_api_query.ga_api_caller_many, ga_key_file, queries,
+                              max_workers=max_workers, scheduler=scheduler, timeout=timeout)
+
+
+class _AsyncWrapper:
+    resource = None
+    methods = ()
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+
+    def __getattr__(self, name):
+        if name not in self.methods:
+            raise AttributeError(f"{type(self).__name__} has no async method {name}")
+        method = getattr(self.wrapped, name)
+
+        async def call(*args, timeout=None, **kwargs):
+            return await run_blocking(self.resource, method, *args, timeout=timeout, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
+
+
+class AsyncGoogleAnalyticsService(_AsyncWrapper):
+    """
+    Async methods for a GoogleAnalyticsService, each runs on the analytics executor
+    and takes an extra timeout keyword in seconds
+    """
+    resource = ANALYTICS
+    methods = ('ga_api_caller', 'ga_api_caller_many', 'ga_api_caller_sharded')
+
+
+class AsyncGoogleDriveService(_AsyncWrapper):
+    """
+    Async methods for a GoogleDriveService, each runs on the drive executor
+    and takes an extra timeout keyword in seconds
+    """
+    resource = DRIVE
+    methods = ('ls', 'walk', 'find_folder', 'get_metadata', 'download_file', 'download_many', 'read_dataframe',
+               'upload_file', 'upload_directory', 'create_folder', 'enable_index')
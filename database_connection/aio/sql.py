@@ -0,0 +1,112 @@
+import asyncio
+import contextlib
+import functools
+
+import pyodbc
+
+from .. import sql_connection
+from .executors import get_executor, run_blocking
+
+RESOURCE = 'sql'
+
+
+async def get_connection(config_path, config_section='DEFAULT', use_database=False, timeout=None):
+    return await run_blocking(RESOURCE, sql_connection.get_connection, config_path,
+                              config_section=config_section, use_database=use_database, timeout=timeout)
+
+
+async def run_sql(cursor, query=None, sql_loc=None, sql_vars=None, fetch_results=True, timeout=None):
+    """
+    Async sql_connection.run_sql. A cursor must only be used by one call at a time,
+    give concurrent queries their own connections, e.g. from a ConnectionPool
+    """
+    return await run_blocking(RESOURCE, sql_connection.run_sql, cursor, query=query, sql_loc=sql_loc,
+                              sql_vars=sql_vars, fetch_results=fetch_results, timeout=timeout)
+
+
+async def run_sql_text_query(query, cursor, commit_change=False, connection=None, timeout=None):
+    return await run_blocking(RESOURCE, sql_connection.run_sql_text_query, query, cursor,
+                              commit_change=commit_change, connection=connection, timeout=timeout)
+
+
+async def run_sql_df(cursor, query=None, sql_loc=None, sql_vars=None, timeout=None):
+    """
+    Run a query and build its dataframe in one executor call
+    :return: dataframe
+    """
+    def run():
+        result_cursor, rows = sql_connection.run_sql(cursor, query=query, sql_loc=sql_loc, sql_vars=sql_vars)
+        return sql_connection.row_to_df(rows, result_cursor)
+
+    return await run_blocking(RESOURCE, run, timeout=timeout)
+
+
+async def bulk_insert(connection, dataframe, database_name, table_name, columns=None,
+                      batch_size=sql_connection.BULK_INSERT_BATCH_SIZE, timeout=None):
+    return await run_blocking(RESOURCE, sql_connection.bulk_insert, connection, dataframe, database_name,
+                              table_name, columns=columns, batch_size=batch_size, timeout=timeout)
+
+
+async def upsert_dataframe(connection, df, key_columns, database_name, table_name,
+                           batch_size=sql_connection.BULK_INSERT_BATCH_SIZE, timeout=None):
+    return await run_blocking(RESOURCE, sql_connection.upsert_dataframe, connection, df, key_columns,
+                              database_name, table_name, batch_size=batch_size, timeout=timeout)
+
+
+async def export_query(cursor, query, path, format='parquet', chunk_size=sql_connection.FETCH_CHUNK_SIZE,
+                       compression=None, progress=None, timeout=None):
+    return await run_blocking(RESOURCE, sql_connection.export_query, cursor, query, path, format=format,
+                              chunk_size=chunk_size, compression=compression, progress=progress, timeout=timeout)
+
+
+def _checkout(pool):
+    """ acquire a connection and open its cursor, releasing the connection if the cursor can't be opened """
+    connection = pool.acquire()
+    try:
+        return connection, connection.cursor()
+    except BaseException:
+        pool.release(connection, discard=True)
+        raise
+
+
+def _close_and_release(pool, connection, cursor, discard=False):
+    """ close the cursor and always give the connection back, discarding it if the cursor won't close """
+    try:
+        cursor.close()
+    except pyodbc.Error:
+        discard = True
+    pool.release(connection, discard=discard)
+
+
+def _release_when_acquired(pool, future):
+    """ give back a connection whose checkout finished after the task waiting for it stopped waiting """
+    if not future.cancelled() and future.exception() is None:
+        get_executor(RESOURCE).submit(_close_and_release, pool, *future.result())
+
+
+@contextlib.asynccontextmanager
+async def pooled_connection(pool):
+    """
+    Check a (connection, cursor) pair out of a ConnectionPool without blocking the event loop,
+    waiting at most the pool's checkout_timeout. The cursor is opened and closed on the executor as well
+    :param pool: ConnectionPool
+    """
+    loop = asyncio.get_running_loop()
+    checking_out = loop.run_in_executor(get_executor(RESOURCE), _checkout, pool)
+    try:
+        # shielded so a cancelled or timed out wait leaves the checkout running, and it is released when done
+        connection, cursor = await asyncio.shield(checking_out)
+    except asyncio.CancelledError:
+        checking_out.add_done_callback(functools.partial(_release_when_acquired, pool))
+        raise
+
+    discard = False
+    try:
+        yield connection, cursor
+    except pyodbc.Error:
+        discard = True
+        raise
+    finally:
+        # shielded too, so cancelling the task while it waits can't stop the connection going back
+        await asyncio.shield(loop.run_in_executor(get_executor(RESOURCE), _close_and_release, pool, connection,
+                                                  cursor, discard))
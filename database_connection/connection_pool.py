@@ -0,0 +1,200 @@
+import contextlib
+import threading
+import time
+from collections import deque
+
+import pyodbc
+
+from .sql_connection import get_connection
+from .sql_template import default_registry
+
+
+class ConnectionPool:
+
+    def __init__(self, config_path, config_section='DEFAULT', use_database=False,
+                 min_size=1, max_size=5, max_idle_seconds=300, checkout_timeout=30):
+        """
+        Keep a set of open pyodbc connections for one config section so that repeated
+        queries do not each pay for a new encrypted login
+        :param config_path: path for the configuration file which contains the connection information
+        :param config_section: which section of the config file to use
+        :param use_database: connect using the database name
+        :param min_size: number of idle connections kept open even once they pass max_idle_seconds
+        :param max_size: maximum number of connections open at once, checked out or idle
+        :param max_idle_seconds: idle connections older than this are closed, down to min_size
+        :param checkout_timeout: seconds to wait for a free connection before raising TimeoutError
+        """
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1")
+
+        self.config_path = config_path
+        self.config_section = config_section
+        self.use_database = use_database
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.checkout_timeout = checkout_timeout
+
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        cnxn, cursor = get_connection(self.config_path, self.config_section, self.use_database)
+        cursor.close()
+        return cnxn
+
+    @staticmethod
+    def _is_healthy(cnxn):
+        try:
+            cursor = cnxn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(cnxn):
+        # drop any prepared template cursors first, they would otherwise keep the connection alive
+        default_registry.forget_connection(cnxn)
+        try:
+            cnxn.close()
+        except pyodbc.Error:
+            pass
+
+    def _evict_idle(self):
+        """ close connections which have been idle too long, must be called holding the lock """
+        now = time.monotonic()
+        while len(self._idle) > self.min_size and now - self._idle[0][1] > self.max_idle_seconds:
+            cnxn, _ = self._idle.popleft()
+            self._size -= 1
+            self._close_quietly(cnxn)
+
+    def acquire(self):
+        """
+        Check out a healthy connection, opening a new one if the pool is below max_size
+        :return: pyodbc connection
+        """
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The connection pool has been closed")
+                self._evict_idle()
+                if self._idle:
+                    cnxn, _ = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    cnxn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No connection became free within {self.checkout_timeout} seconds")
+                self._condition.wait(remaining)
+
+        try:
+            if cnxn is None:
+                return self._connect()
+            if self._is_healthy(cnxn):
+                return cnxn
+            self._close_quietly(cnxn)
+            return self._connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, cnxn, discard=False):
+        """
+        Return a connection to the pool
+        :param cnxn: connection from acquire
+        :param discard: close the connection instead of keeping it, e.g. after an error
+        """
+        if not discard:
+            try:
+                cnxn.rollback()
+            except pyodbc.Error:
+                discard = True
+
+        with self._condition:
+            if discard or self._closed:
+                self._size -= 1
+                self._close_quietly(cnxn)
+            else:
+                self._idle.append((cnxn, time.monotonic()))
+                self._evict_idle()
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of a with block
+        :return: (connection, cursor) in the same form as get_connection
+        """
+        cnxn = self.acquire()
+        try:
+            cursor = cnxn.cursor()
+        except BaseException:
+            self.release(cnxn, discard=True)
+            raise
+
+        discard = False
+        try:
+            yield cnxn, cursor
+        except pyodbc.Error:
+            discard = True
+            raise
+        finally:
+            # close the cursor before the connection can be checked out by another thread
+            try:
+                cursor.close()
+            except pyodbc.Error:
+                discard = True
+            self.release(cnxn, discard=discard)
+
+    def close(self):
+        """ close every idle connection, connections still checked out are closed when released """
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                cnxn, _ = self._idle.popleft()
+                self._size -= 1
+                self._close_quietly(cnxn)
+            self._condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(config_path, config_section='DEFAULT', use_database=False, **pool_kwargs):
+    """
+    Return the shared pool for this config, creating it on first use
+    :param config_path: path for the configuration file which contains the connection information
+    :param config_section: which section of the config file to use
+    :param use_database: connect using the database name
+    :param pool_kwargs: passed to ConnectionPool when the pool is created
+    :return: ConnectionPool
+    """
+    key = (config_path, config_section, use_database)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool._closed:
+            pool = ConnectionPool(config_path, config_section, use_database, **pool_kwargs)
+            _pools[key] = pool
+    return pool
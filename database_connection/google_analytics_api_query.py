@@ -1,107 +1,70 @@
-import numpy as np
-import pandas as pd
-import json
-from google.oauth2 import service_account
-from apiclient import discovery
+from .google_api_service import get_service_account_service, get_service_account_credentials
+from .google_analytics_reports import fetch_report_parsers, split_report_requests, run_concurrently, \
+    ReportParser, report_to_df, DEFAULT_MAX_WORKERS
 
+ANALYTICS_SCOPES = ['https://www.googleapis.com/auth/analytics.readonly']
 
-def create_service(credentials_file):
-    # Create service credentials
-    credentials = service_account.Credentials.from_service_account_file(credentials_file,
-                                                                        scopes=[
-                                                                            'https://www.googleapis.com/auth/analytics.readonly'])
-    # Create a service object
-    service = discovery.build('analyticsreporting', 'v4', credentials=credentials)
-    return service
 
+def create_service(credentials_file):
+    # Reuse the credentials and this thread's service object between calls
+    return get_service_account_service(credentials_file, 'analyticsreporting', 'v4', ANALYTICS_SCOPES)
 
-def get_dimension_row_names(response):
-    if 'dimensions' in response['reports'][0]['columnHeader']:
-        row_index_names = response['reports'][0]['columnHeader']['dimensions']
-        row_index = [element['dimensions'] for element in response['reports'][0]['data']['rows']]
-        row_index_named = pd.MultiIndex.from_arrays(np.transpose(np.array(row_index)),
-                                                    names=np.array(row_index_names))
-    else:
-        row_index_named = None
-    return row_index_named
 
+def project_id(credentials_file):
+    return getattr(get_service_account_credentials(credentials_file, ANALYTICS_SCOPES), 'project_id', None)
 
-def metric_report_df(response):
-    # extract column names
-    summary_column_names = [item['name'] for item in response['reports'][0]
-    ['columnHeader']['metricHeader']['metricHeaderEntries']]
 
-    # extract table values
-    summary_values = [element['metrics'][0]['values'] for element in response['reports'][0]['data']['rows']]
+def get_dimension_row_names(response):
+    return ReportParser.from_report(response['reports'][0]).dimension_index()
 
-    # Use dimension names to get rows
-    row_index_named = get_dimension_row_names(response=response)
 
-    # combine. I used type 'float' because default is object, and as far as I know, all values are numeric
-    return pd.DataFrame(data=np.array(summary_values),
-                        index=row_index_named,
-                        columns=summary_column_names).astype('float')
+def metric_report_df(response):
+    return ReportParser.from_report(response['reports'][0]).metric_df()
 
 
 def pivot_report_df(response):
-    # extract table values
-    pivot_values = [item['metrics'][0]['pivotValueRegions'][0]['values'] for item in
-                    response['reports'][0]['data']['rows']]
+    return ReportParser.from_report(response['reports'][0]).pivot_df()
 
-    # create column index
-    top_header = [item['dimensionValues'] for item in
-                  response['reports'][0]['columnHeader']['metricHeader']['pivotHeaders'][0]['pivotHeaderEntries']]
-    column_metrics = [item['metric']['name'] for item in
-                      response['reports'][0]['columnHeader']['metricHeader']['pivotHeaders'][0][
-                          'pivotHeaderEntries']]
-    array = np.concatenate((np.array(top_header),
-                            np.array(column_metrics).reshape((len(column_metrics), 1))),
-                           axis=1)
-    column_index = pd.MultiIndex.from_arrays(np.transpose(array))
 
-    row_index_named = get_dimension_row_names(response=response)
+def _query_reports_to_dfs(service, query, scheduler=None, project=None):
+    return [parser.to_df()
+            for batch in split_report_requests(query)
+            for parser in fetch_report_parsers(service, batch, scheduler=scheduler, project=project)]
 
-    return pd.DataFrame(data=np.array(pivot_values),
-                        index=row_index_named,
-                        columns=column_index).astype('float')
 
-
-def ga_api_caller(ga_key_file, query):
+def ga_api_caller(ga_key_file, query, scheduler=None):
+    """
+    Run a Reporting API v4 query, fetching every page of every report
+    :param ga_key_file: service account credentials file
+    :param query: batchGet body, more than 5 reportRequests are split over several batchGets
+    :param scheduler: RequestScheduler the batchGets go through, defaults to the shared scheduler
+    :return: a DataFrame for a single reportRequest, otherwise a list with one DataFrame per reportRequest
+    """
     service = create_service(credentials_file=ga_key_file)
-
-    if query['reportRequests'].__len__() == 1:
-        response_raw_data = service.reports().batchGet(body=query).execute()
-
-        response_data = response_raw_data['reports'][0].get('data', [])
-        if not response_data:
-            print("No data was returned")
-            return pd.DataFrame()
-
-        next_page_token = response_raw_data['reports'][0].get('nextPageToken', False)
-
-        while next_page_token:
-            query['reportRequests'][0]['pageToken'] = next_page_token
-            next_page_response_raw_data = service.reports().batchGet(body=query).execute()
-            response_data['rows'].extend(next_page_response_raw_data['reports'][0]['data'].get('rows', []))
-            next_page_token = next_page_response_raw_data['reports'][0].get('nextPageToken', False)
-    else:
-        e_mess = "This only works for single queries, add functionality for multiple queries if thats what you like"
-        raise TypeError(e_mess)
-
-    response_raw_data['reports'][0]['data'] = response_data
-
-    if 'pivotValueRegions' in response_raw_data['reports'][0]['data']['rows'][0]['metrics'][0]:
-        df_pivot = pivot_report_df(response=response_raw_data)
-    else:
-        df_pivot = pd.DataFrame()
-
-    if 'metricHeader' in response_raw_data['reports'][0]['columnHeader']:
-        df_metric = metric_report_df(response=response_raw_data)
-    else:
-        df_metric = pd.DataFrame()
-
-    if df_pivot.columns.nlevels == 2:
-        df_metric.columns = [[''] * len(df_metric.columns), df_metric.columns]
-
-    df_report = (pd.concat([df_metric, df_pivot], axis=1))
-    return df_report
+    dfs = _query_reports_to_dfs(service, query, scheduler=scheduler, project=project_id(ga_key_file))
+    return dfs[0] if len(dfs) == 1 else dfs
+
+
+def ga_api_caller_many(ga_key_file, queries, max_workers=DEFAULT_MAX_WORKERS, scheduler=None):
+    """
+    Run many queries, with their batchGets made concurrently on a thread pool
+    :param ga_key_file: service account credentials file
+    :param queries: list of batchGet bodies
+    :param max_workers: number of batchGets in flight at once
+    :param scheduler: RequestScheduler the batchGets go through, defaults to the shared scheduler
+    :return: list with the ga_api_caller result for each query
+    """
+    project = project_id(ga_key_file)
+    batches = [(query_number, batch)
+               for query_number, query in enumerate(queries)
+               for batch in split_report_requests(query)]
+
+    batch_dfs = run_concurrently(
+        lambda item: _query_reports_to_dfs(create_service(credentials_file=ga_key_file), item[1],
+                                           scheduler=scheduler, project=project),
+        batches, max_workers=max_workers)
+
+    query_dfs = [[] for _ in queries]
+    for (query_number, _), dfs in zip(batches, batch_dfs):
+        query_dfs[query_number].extend(dfs)
+    return [dfs[0] if len(dfs) == 1 else dfs for dfs in query_dfs]
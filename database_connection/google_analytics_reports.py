@@ -0,0 +1,317 @@
+import copy
+import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .google_api_scheduler import default_scheduler
+from .instrumentation import logger, timed
+
+API_NAME = 'analyticsreporting'
+MAX_REPORT_REQUESTS = 5
+DEFAULT_MAX_WORKERS = 4
+GA_DATE_FORMAT = '%Y-%m-%d'
+DAYS_AGO = re.compile(r'^(\d+)daysAgo$')
+SHARD_DAYS = {'day': 1, 'week': 7}
+
+
+def batch_get_reports(service, query, on_page=None, scheduler=None, project=None):
+    """
+    Run a Reporting API v4 batchGet for up to 5 reportRequests, following each report's
+    nextPageToken independently until every report is complete
+    :param service: analyticsreporting v4 service object
+    :param query: batchGet body, it is not modified
+    :param on_page: optional callback called with (report_number, report) for every page as it arrives,
+    in which case the pages are not kept and None is returned
+    :param scheduler: RequestScheduler the batchGets go through, defaults to the shared scheduler
+    :param project: project the rate limit is shared with
+    :return: list with one report per reportRequest, all pages' rows merged into report['data']['rows']
+    """
+    report_requests = [copy.deepcopy(request) for request in query['reportRequests']]
+    if not report_requests:
+        raise ValueError("The query has no reportRequests")
+    if len(report_requests) > MAX_REPORT_REQUESTS:
+        raise ValueError(f"A batchGet can contain at most {MAX_REPORT_REQUESTS} reportRequests, "
+                         f"got {len(report_requests)}")
+
+    scheduler = scheduler or default_scheduler
+    reports = [None] * len(report_requests)
+    pending = list(range(len(report_requests)))
+
+    while pending:
+        body = dict(query, reportRequests=[report_requests[i] for i in pending])
+        with timed('analytics.batch_get', reports=len(pending)) as metrics:
+            response = scheduler.execute(service.reports().batchGet(body=body), api=API_NAME, project=project)
+            metrics['pages'] = len(response['reports'])
+            metrics['rows'] = sum(len(report.get('data', {}).get('rows', [])) for report in response['reports'])
+
+        still_pending = []
+        for i, report in zip(pending, response['reports']):
+            if on_page is not None:
+                on_page(i, report)
+            elif reports[i] is None:
+                reports[i] = report
+                report.setdefault('data', {}).setdefault('rows', [])
+            else:
+                reports[i]['data']['rows'].extend(report.get('data', {}).get('rows', []))
+
+            next_page_token = report.get('nextPageToken', False)
+            if next_page_token:
+                report_requests[i]['pageToken'] = next_page_token
+                still_pending.append(i)
+        pending = still_pending
+
+    if on_page is not None:
+        return None
+    for report in reports:
+        report.pop('nextPageToken', None)
+    return reports
+
+
+def fetch_report_parsers(service, query, scheduler=None, project=None):
+    """
+    Run a batchGet of up to 5 reportRequests, parsing each page as it arrives
+    :param service: analyticsreporting v4 service object
+    :param query: batchGet body
+    :param scheduler: RequestScheduler the batchGets go through, defaults to the shared scheduler
+    :param project: project the rate limit is shared with
+    :return: list with one ReportParser per reportRequest
+    """
+    parsers = [None] * len(query['reportRequests'])
+
+    def on_page(report_number, report):
+        if parsers[report_number] is None:
+            parsers[report_number] = ReportParser(report.get('columnHeader', {}))
+        parsers[report_number].add_page(report)
+
+    batch_get_reports(service, query, on_page=on_page, scheduler=scheduler, project=project)
+    return parsers
+
+
+def split_report_requests(query):
+    """
+    Split a query with more than 5 reportRequests into batchGet bodies of at most 5
+    :param query: batchGet body
+    :return: list of batchGet bodies
+    """
+    report_requests = query['reportRequests']
+    return [dict(query, reportRequests=report_requests[start:start + MAX_REPORT_REQUESTS])
+            for start in range(0, len(report_requests), MAX_REPORT_REQUESTS)]
+
+
+def run_concurrently(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Call func on every item using a thread pool
+    :return: list of results in the same order as items
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def resolve_ga_date(value, today=None):
+    """
+    Turn a Reporting API date, YYYY-MM-DD, today, yesterday or NdaysAgo, into a date
+    :param value: the date string
+    :param today: date treated as today, defaults to the local date
+    :return: datetime.date
+    """
+    today = today or datetime.date.today()
+    if value == 'today':
+        return today
+    if value == 'yesterday':
+        return today - datetime.timedelta(days=1)
+    days_ago = DAYS_AGO.match(value)
+    if days_ago:
+        return today - datetime.timedelta(days=int(days_ago.group(1)))
+    return datetime.datetime.strptime(value, GA_DATE_FORMAT).date()
+
+
+def date_shards(start_date, end_date, shard='day'):
+    """
+    Split an inclusive date range into consecutive dateRanges of a day or a week
+    :param start_date: datetime.date
+    :param end_date: datetime.date
+    :param shard: 'day' or 'week'
+    :return: list of {'startDate', 'endDate'} dicts
+    """
+    if shard not in SHARD_DAYS:
+        raise ValueError(f"shard must be one of {list(SHARD_DAYS)}")
+    step = datetime.timedelta(days=SHARD_DAYS[shard])
+    shards = []
+    while start_date <= end_date:
+        shard_end = min(start_date + step - datetime.timedelta(days=1), end_date)
+        shards.append({'startDate': start_date.strftime(GA_DATE_FORMAT),
+                       'endDate': shard_end.strftime(GA_DATE_FORMAT)})
+        start_date = shard_end + datetime.timedelta(days=1)
+    return shards
+
+
+def split_date_range(date_range):
+    """
+    Halve a dateRange, used to re-fetch a shard which came back sampled
+    :return: list of one or two dateRanges, one if the range is a single day
+    """
+    start_date = resolve_ga_date(date_range['startDate'])
+    end_date = resolve_ga_date(date_range['endDate'])
+    if start_date >= end_date:
+        return [date_range]
+    middle = start_date + (end_date - start_date) // 2
+    return [{'startDate': start_date.strftime(GA_DATE_FORMAT), 'endDate': middle.strftime(GA_DATE_FORMAT)},
+            {'startDate': (middle + datetime.timedelta(days=1)).strftime(GA_DATE_FORMAT),
+             'endDate': end_date.strftime(GA_DATE_FORMAT)}]
+
+
+class _GrowableBuffer:
+
+    def __init__(self, n_columns, dtype, capacity=1024):
+        """ 2d numpy buffer with amortised appends by doubling its capacity """
+        self._data = np.empty((capacity, n_columns), dtype=dtype)
+        self.size = 0
+
+    def extend(self, block):
+        needed = self.size + len(block)
+        if needed > len(self._data):
+            grown = np.empty((max(needed, 2 * len(self._data)), self._data.shape[1]), dtype=self._data.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:needed] = block
+        self.size = needed
+
+    @property
+    def values(self):
+        if len(self._data) > self.size:
+            # drop the spare capacity so the dataframe does not keep it alive
+            self._data = self._data[:self.size].copy()
+        return self._data
+
+
+class ReportParser:
+
+    def __init__(self, column_header):
+        """
+        Incremental parser for a Reporting API v4 report. Pages are added as they arrive; metric values
+        go straight into float64 buffers and dimension values are stored as integer codes, one
+        lookup per dimension, so the full json rows never need to be kept.
+        Every dateRange is kept, when there is more than one each metric column name gets a _dateRange{n} suffix
+        :param column_header: the report's columnHeader
+        """
+        self.dimension_names = column_header.get('dimensions', [])
+        metric_header = column_header.get('metricHeader', {})
+        self.has_metric_header = 'metricHeader' in column_header
+        self.metric_names = [entry['name'] for entry in metric_header.get('metricHeaderEntries', [])]
+        self.pivot_entries = [(entry.get('dimensionValues', []), entry['metric']['name'])
+                              for pivot_header in metric_header.get('pivotHeaders', [])
+                              for entry in pivot_header.get('pivotHeaderEntries', [])]
+
+        self.n_rows = 0
+        self.n_date_ranges = None
+        self.samples_read_counts = None
+        self._lookups = [{} for _ in self.dimension_names]
+        self._codes = _GrowableBuffer(len(self.dimension_names), np.int32)
+        self._metrics = None
+        self._pivots = None
+
+    @classmethod
+    def from_report(cls, report):
+        parser = cls(report.get('columnHeader', {}))
+        parser.add_page(report)
+        return parser
+
+    @property
+    def sampled(self):
+        return bool(self.samples_read_counts)
+
+    def add_page(self, report):
+        data = report.get('data', {})
+        if data.get('samplesReadCounts'):
+            self.samples_read_counts = data['samplesReadCounts']
+
+        rows = data.get('rows', [])
+        if not rows:
+            return
+
+        if self.n_date_ranges is None:
+            self.n_date_ranges = len(rows[0]['metrics'])
+            self._metrics = _GrowableBuffer(len(self.metric_names) * self.n_date_ranges, np.float64)
+            self._pivots = _GrowableBuffer(len(self.pivot_entries) * self.n_date_ranges, np.float64)
+
+        if self._lookups:
+            codes = np.empty((len(rows), len(self._lookups)), dtype=np.int32)
+            for column, lookup in enumerate(self._lookups):
+                codes[:, column] = [lookup.setdefault(row['dimensions'][column], len(lookup)) for row in rows]
+            self._codes.extend(codes)
+
+        # numpy parses the value strings directly when given a float dtype
+        metric_values = np.array([[value for date_range in row['metrics'] for value in date_range['values']]
+                                  for row in rows], dtype=np.float64)
+        self._metrics.extend(metric_values.reshape(len(rows), self._metrics._data.shape[1]))
+
+        if self.pivot_entries:
+            pivot_values = np.array([[value
+                                      for date_range in row['metrics']
+                                      for region in date_range.get('pivotValueRegions', [])
+                                      for value in region.get('values', [])]
+                                     for row in rows], dtype=np.float64)
+            self._pivots.extend(pivot_values.reshape(len(rows), self._pivots._data.shape[1]))
+
+        self.n_rows += len(rows)
+
+    def _column_name(self, name, date_range):
+        return name if self.n_date_ranges == 1 else f'{name}_dateRange{date_range}'
+
+    def dimension_index(self):
+        if not self.dimension_names:
+            return None
+        codes = self._codes.values
+        return pd.MultiIndex(levels=[list(lookup) for lookup in self._lookups],
+                             codes=[codes[:, column] for column in range(len(self._lookups))],
+                             names=self.dimension_names,
+                             verify_integrity=False)
+
+    def metric_df(self):
+        columns = [self._column_name(name, date_range)
+                   for date_range in range(self.n_date_ranges or 1)
+                   for name in self.metric_names]
+        values = self._metrics.values if self._metrics is not None else np.empty((0, len(columns)))
+        return pd.DataFrame(data=values, index=self.dimension_index(), columns=columns)
+
+    def pivot_df(self):
+        n_levels = max(len(dimension_values) for dimension_values, _ in self.pivot_entries)
+        columns = [tuple(list(dimension_values) + [''] * (n_levels - len(dimension_values)) +
+                         [self._column_name(metric, date_range)])
+                   for date_range in range(self.n_date_ranges or 1)
+                   for dimension_values, metric in self.pivot_entries]
+        values = self._pivots.values if self._pivots is not None else np.empty((0, len(columns)))
+        return pd.DataFrame(data=values, index=self.dimension_index(), columns=pd.MultiIndex.from_tuples(columns))
+
+    def to_df(self):
+        """
+        Combine the metric and pivot values into one dataframe indexed by the dimensions
+        :return: DataFrame, empty if the report had no rows
+        """
+        if not self.n_rows:
+            logger.info("No data was returned")
+            return pd.DataFrame()
+
+        df_pivot = self.pivot_df() if self.pivot_entries else pd.DataFrame()
+        df_metric = self.metric_df() if self.has_metric_header else pd.DataFrame()
+
+        if df_pivot.columns.nlevels > 1:
+            padding = [[''] * len(df_metric.columns)] * (df_pivot.columns.nlevels - 1)
+            df_metric.columns = pd.MultiIndex.from_arrays(padding + [list(df_metric.columns)])
+
+        return pd.concat([df_metric, df_pivot], axis=1)
+
+
+def report_to_df(report):
+    """
+    Build the dataframe for a report whose pages have already been merged
+    :param report: one entry of a batchGet response's reports
+    :return: DataFrame
+    """
+    return ReportParser.from_report(report).to_df()
@@ -1,111 +1,118 @@
-import numpy as np
+import copy
 import pandas as pd
-import json
-from google.oauth2 import service_account
-from apiclient import discovery
+from .google_api_service import get_service_account_service
+from .google_analytics_api_query import ANALYTICS_SCOPES, project_id
+from .google_api_scheduler import default_scheduler
+from .instrumentation import logger
+from .google_analytics_reports import fetch_report_parsers, split_report_requests, run_concurrently, \
+    ReportParser, report_to_df, DEFAULT_MAX_WORKERS, date_shards, resolve_ga_date, split_date_range
+
+DATE_DIMENSIONS = {'ga:date', 'ga:dateHour', 'ga:dateHourMinute'}
 
 
 class GoogleAnalyticsService:
 
-    def __init__(self, credentials_file):
+    def __init__(self, credentials_file, scheduler=None):
         self.credentials_file = credentials_file
+        self.scheduler = scheduler or default_scheduler
+        self.project = project_id(credentials_file)
         self.service = self.create_service()
 
     def create_service(self):
-        # Create service credentials
-        credentials = service_account.Credentials.from_service_account_file(self.credentials_file,
-                                                                            scopes=[
-                                                                                'https://www.googleapis.com/auth/analytics.readonly'])
-        # Create a service object
-        service = discovery.build('analyticsreporting', 'v4', credentials=credentials)
-        return service
+        # Reuse the credentials and this thread's service object between calls
+        return get_service_account_service(self.credentials_file, 'analyticsreporting', 'v4', ANALYTICS_SCOPES)
+
+    def _fetch_report_parsers(self, service, query):
+        return fetch_report_parsers(service, query, scheduler=self.scheduler, project=self.project)
 
     def ga_api_caller(self, query):
+        """
+        Run a Reporting API v4 query, fetching every page of every report
+        :param query: batchGet body, more than 5 reportRequests are split over several batchGets
+        :return: a DataFrame for a single reportRequest, otherwise a list with one DataFrame per reportRequest
+        """
+        dfs = [parser.to_df()
+               for batch in split_report_requests(query)
+               for parser in self._fetch_report_parsers(self.create_service(), batch)]
+        return dfs[0] if len(dfs) == 1 else dfs
+
+    def ga_api_caller_many(self, queries, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Run many queries, with their batchGets made concurrently on a thread pool.
+        Each worker thread uses its own service object as they are not thread safe
+        :param queries: list of batchGet bodies
+        :param max_workers: number of batchGets in flight at once
+        :return: list with the ga_api_caller result for each query
+        """
+        batches = [(query_number, batch)
+                   for query_number, query in enumerate(queries)
+                   for batch in split_report_requests(query)]
+
+        batch_dfs = run_concurrently(
+            lambda item: [parser.to_df() for parser in self._fetch_report_parsers(self.create_service(), item[1])],
+            batches, max_workers=max_workers)
+
+        query_dfs = [[] for _ in queries]
+        for (query_number, _), dfs in zip(batches, batch_dfs):
+            query_dfs[query_number].extend(dfs)
+        return [dfs[0] if len(dfs) == 1 else dfs for dfs in query_dfs]
+
+    def ga_api_caller_sharded(self, query, shard='day', max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Run a single report query split into day or week date ranges, fetched in parallel.
+        Shards which come back sampled are halved and fetched again until unsampled or a single day.
+        The report must have one dateRange and a date dimension (ga:date, ga:dateHour or ga:dateHourMinute)
+        so the shards' rows can be stacked into the same layout as ga_api_caller returns
+        :param query: batchGet body with one reportRequest
+        :param shard: 'day' or 'week'
+        :param max_workers: number of shards fetched at once
+        :return: DataFrame
+        """
+        if len(query['reportRequests']) != 1:
+            raise ValueError("Sharding only works for queries with a single reportRequest")
+        report_request = query['reportRequests'][0]
+        if len(report_request.get('dateRanges', [])) != 1:
+            raise ValueError("Sharding only works for reportRequests with a single dateRange")
+        dimensions = [dimension['name'] for dimension in report_request.get('dimensions', [])]
+        if not set(dimensions) & DATE_DIMENSIONS:
+            raise ValueError(f"Sharding needs one of {sorted(DATE_DIMENSIONS)} in the dimensions")
+
+        date_range = report_request['dateRanges'][0]
+        shards = date_shards(resolve_ga_date(date_range['startDate']),
+                             resolve_ga_date(date_range['endDate']),
+                             shard=shard)
+
+        shard_dfs = run_concurrently(lambda shard_range: self._fetch_unsampled_shard(query, shard_range),
+                                     shards, max_workers=max_workers)
+        dfs = [df for dfs in shard_dfs for df in dfs if not df.empty]
+        if not dfs:
+            return pd.DataFrame()
+        return pd.concat(dfs, axis=0)
+
+    def _fetch_unsampled_shard(self, query, date_range):
+        shard_query = copy.deepcopy(query)
+        shard_query['reportRequests'][0]['dateRanges'] = [date_range]
+        parser = self._fetch_report_parsers(self.create_service(), shard_query)[0]
+
+        if parser.sampled:
+            halves = split_date_range(date_range)
+            if len(halves) > 1:
+                return [df for half in halves for df in self._fetch_unsampled_shard(query, half)]
+            logger.warning("Report for %s is sampled even for a single day", date_range['startDate'])
+        return [parser.to_df()]
 
-        if query['reportRequests'].__len__() == 1:
-            response_raw_data = self.service.reports().batchGet(body=query).execute()
-
-            response_data = response_raw_data['reports'][0].get('data', [])
-            if not response_data:
-                print("No data was returned")
-                return pd.DataFrame()
-
-            next_page_token = response_raw_data['reports'][0].get('nextPageToken', False)
-
-            while next_page_token:
-                query['reportRequests'][0]['pageToken'] = next_page_token
-                next_page_response_raw_data = self.service.reports().batchGet(body=query).execute()
-                response_data['rows'].extend(next_page_response_raw_data['reports'][0]['data'].get('rows', []))
-                next_page_token = next_page_response_raw_data['reports'][0].get('nextPageToken', False)
-        else:
-            e_mess = "This only works for single queries, add functionality for multiple queries if thats what you like"
-            raise TypeError(e_mess)
-
-        response_raw_data['reports'][0]['data'] = response_data
-
-        if 'pivotValueRegions' in response_raw_data['reports'][0]['data']['rows'][0]['metrics'][0]:
-            df_pivot = self.pivot_report_df(response=response_raw_data)
-        else:
-            df_pivot = pd.DataFrame()
-
-        if 'metricHeader' in response_raw_data['reports'][0]['columnHeader']:
-            df_metric = self.metric_report_df(response=response_raw_data)
-        else:
-            df_metric = pd.DataFrame()
-
-        if df_pivot.columns.nlevels == 2:
-            df_metric.columns = [[''] * len(df_metric.columns), df_metric.columns]
-
-        df_report = (pd.concat([df_metric, df_pivot], axis=1))
-        return df_report
-
-    def metric_report_df(self, response):
-        # extract column names
-        summary_column_names = [item['name'] for item in response['reports'][0]
-        ['columnHeader']['metricHeader']['metricHeaderEntries']]
-
-        # extract table values
-        summary_values = [element['metrics'][0]['values'] for element in response['reports'][0]['data']['rows']]
-
-        # Use dimension names to get rows
-        row_index_named = self.get_dimension_row_names(response=response)
-
-        # combine. I used type 'float' because default is object, and as far as I know, all values are numeric
-        return pd.DataFrame(data=np.array(summary_values),
-                            index=row_index_named,
-                            columns=summary_column_names).astype('float')
-
-    def pivot_report_df(self, response):
-        # extract table values
-        pivot_values = [item['metrics'][0]['pivotValueRegions'][0]['values'] for item in
-                        response['reports'][0]['data']['rows']]
-
-        # create column index
-        top_header = [item['dimensionValues'] for item in
-                      response['reports'][0]['columnHeader']['metricHeader']['pivotHeaders'][0]['pivotHeaderEntries']]
-        column_metrics = [item['metric']['name'] for item in
-                          response['reports'][0]['columnHeader']['metricHeader']['pivotHeaders'][0][
-                              'pivotHeaderEntries']]
-        array = np.concatenate((np.array(top_header),
-                                np.array(column_metrics).reshape((len(column_metrics), 1))),
-                               axis=1)
-        column_index = pd.MultiIndex.from_arrays(np.transpose(array))
-
-        row_index_named = self.get_dimension_row_names(response=response)
-
-        return pd.DataFrame(data=np.array(pivot_values),
-                            index=row_index_named,
-                            columns=column_index).astype('float')
+    @staticmethod
+    def report_to_df(report):
+        return report_to_df(report)
 
     @staticmethod
-    def get_dimension_row_names(response):
-        if 'dimensions' in response['reports'][0]['columnHeader']:
-            row_index_names = response['reports'][0]['columnHeader']['dimensions']
-            row_index = [element['dimensions'] for element in response['reports'][0]['data']['rows']]
-            row_index_named = pd.MultiIndex.from_arrays(np.transpose(np.array(row_index)),
-                                                        names=np.array(row_index_names))
-        else:
-            row_index_named = None
-        return row_index_named
+    def metric_report_df(response):
+        return ReportParser.from_report(response['reports'][0]).metric_df()
 
+    @staticmethod
+    def pivot_report_df(response):
+        return ReportParser.from_report(response['reports'][0]).pivot_df()
 
+    @staticmethod
+    def get_dimension_row_names(response):
+        return ReportParser.from_report(response['reports'][0]).dimension_index()
@@ -0,0 +1,128 @@
+import copy
+import datetime
+
+from .google_analytics_reports import resolve_ga_date, GA_DATE_FORMAT, DEFAULT_MAX_WORKERS
+from .instrumentation import logger
+from .sql_connection import upsert_dataframe
+
+STATE_TABLE = 'ga_sync_state'
+LOOKBACK_DAYS = 3
+
+
+class GoogleAnalyticsSync:
+
+    def __init__(self, ga_service, connection, database_name, state_table=STATE_TABLE, lookback_days=LOOKBACK_DAYS):
+        """
+        Incrementally copy Reporting API v4 queries into SQL Server tables. The last complete date loaded
+        for each query is kept in a state table, so each run only fetches the dates after it, plus a
+        lookback window to pick up data GA processes late
+        :param ga_service: GoogleAnalyticsService
+        :param connection: pyodbc connection object
+        :param database_name: database holding the state and target tables
+        :param state_table: name of the watermark table, created if it does not exist
+        :param lookback_days: number of days before the watermark to fetch again
+        """
+        self.ga_service = ga_service
+        self.connection = connection
+        self.database_name = database_name
+        self.state_table = state_table
+        self.lookback_days = lookback_days
+        self._ensure_state_table()
+
+    @property
+    def _state_ref(self):
+        return f'[{self.database_name}].[dbo].[{self.state_table}]'
+
+    def _ensure_state_table(self):
+        cursor = self.connection.cursor()
+        cursor.execute(f'''
+                        IF OBJECT_ID('{self.database_name}.dbo.{self.state_table}', 'U') IS NULL
+                        CREATE TABLE {self._state_ref} (
+                            query_name NVARCHAR(200) NOT NULL PRIMARY KEY,
+                            watermark DATE NOT NULL,
+                            updated_at DATETIME2 NOT NULL
+                        )
+                       ''')
+        self.connection.commit()
+        cursor.close()
+
+    def get_watermark(self, query_name):
+        """
+        :param query_name: name the query is synced under
+        :return: last complete date loaded for the query, or None if it has never run
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(f'SELECT watermark FROM {self._state_ref} WHERE query_name = ?', query_name)
+        row = cursor.fetchone()
+        cursor.close()
+        if row is None:
+            return None
+        watermark = row[0]
+        if isinstance(watermark, str):
+            watermark = datetime.datetime.strptime(watermark, GA_DATE_FORMAT).date()
+        return watermark
+
+    def set_watermark(self, query_name, watermark):
+        cursor = self.connection.cursor()
+        cursor.execute(f'''
+                        MERGE {self._state_ref} AS t
+                        USING (SELECT ? AS query_name, ? AS watermark) AS s ON t.query_name = s.query_name
+                        WHEN MATCHED THEN UPDATE SET watermark = s.watermark, updated_at = SYSUTCDATETIME()
+                        WHEN NOT MATCHED THEN INSERT (query_name, watermark, updated_at)
+                            VALUES (s.query_name, s.watermark, SYSUTCDATETIME());
+                       ''', query_name, watermark)
+        self.connection.commit()
+        cursor.close()
+
+    def sync(self, query_name, query, target_table, start_date, end_date='yesterday',
+             shard=None, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Fetch the dates not yet loaded for a query and upsert them into the target table.
+        The query needs a single reportRequest including the ga:date dimension and no pivots. The target
+        table must already exist with a column per dimension and metric, named without the ga: prefix,
+        and the dimension columns are used as the upsert key
+        :param query_name: name the watermark is stored under
+        :param query: batchGet body, its dateRanges are replaced
+        :param target_table: table the rows are upserted into
+        :param start_date: first date to load when the query has no watermark, YYYY-MM-DD or NdaysAgo
+        :param end_date: last date to load, which becomes the new watermark. Defaults to yesterday,
+        the last complete day
+        :param shard: None to fetch the range in one query, or 'day'/'week' to use ga_api_caller_sharded
+        :param max_workers: number of shards fetched at once
+        :return: number of rows inserted or updated
+        """
+        if len(query['reportRequests']) != 1:
+            raise ValueError("Only queries with a single reportRequest can be synced")
+        dimensions = [dimension['name'] for dimension in query['reportRequests'][0].get('dimensions', [])]
+        if 'ga:date' not in dimensions:
+            raise ValueError("The query must include the ga:date dimension to be synced")
+
+        start_date = resolve_ga_date(start_date)
+        end_date = resolve_ga_date(end_date)
+
+        watermark = self.get_watermark(query_name)
+        if watermark is not None:
+            start_date = max(start_date, watermark + datetime.timedelta(days=1 - self.lookback_days))
+        if start_date > end_date:
+            logger.info("%s is already up to date", query_name)
+            return 0
+
+        sync_query = copy.deepcopy(query)
+        sync_query['reportRequests'][0]['dateRanges'] = [{'startDate': start_date.strftime(GA_DATE_FORMAT),
+                                                          'endDate': end_date.strftime(GA_DATE_FORMAT)}]
+        if shard:
+            df = self.ga_service.ga_api_caller_sharded(sync_query, shard=shard, max_workers=max_workers)
+        else:
+            df = self.ga_service.ga_api_caller(sync_query)
+
+        rows = 0
+        if not df.empty:
+            if df.columns.nlevels > 1:
+                raise ValueError("Pivot reports can not be synced into a table")
+            key_columns = [name.replace('ga:', '') for name in df.index.names]
+            df = df.reset_index()
+            df.columns = [str(name).replace('ga:', '') for name in df.columns]
+            rows = upsert_dataframe(self.connection, df, key_columns, self.database_name, target_table)
+
+        self.set_watermark(query_name, end_date)
+        return rows
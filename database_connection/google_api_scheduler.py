@@ -0,0 +1,208 @@
+import json
+import random
+import socket
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from .instrumentation import count, logger
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+QUOTA_REASONS = {'userRateLimitExceeded', 'rateLimitExceeded', 'quotaExceeded'}
+# requests per second from the default per user quotas Google documents for each API: the Reporting API v4
+# allows 100 requests per 100 seconds per user, Drive 12,000 queries per minute per user. Projects with
+# a raised or lowered quota should pass their own rate_limits
+API_RATE_LIMITS = {'analyticsreporting': 1, 'drive': 200}
+# after a quota error a bucket's rate halves, down to this fraction of its configured rate, and each
+# successful call adds this fraction back
+MIN_RATE_FRACTION = 1 / 64
+RATE_RECOVERY = 0.05
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: tokens added per second, lowered by slow_down and restored by speed_up
+        :param capacity: most tokens that can build up, defaults to one second's worth
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """ block until a token is available and take it """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        """ halve the rate after a quota error, dropping any burst that had built up """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0)
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+
+    def speed_up(self):
+        """ move the rate back towards the configured rate after a successful call """
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY)
+
+
+class AdaptiveLimiter:
+
+    def __init__(self, max_concurrency, min_concurrency=1):
+        """
+        Concurrency limit which halves when quota errors are seen and grows back by about one
+        request per round of successful calls
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+def _error_reason(error):
+    try:
+        return json.loads(error.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def is_quota_error(error):
+    if not isinstance(error, HttpError):
+        return False
+    return error.resp.status == 429 or (error.resp.status == 403 and _error_reason(error) in QUOTA_REASONS)
+
+
+def is_retryable(error):
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRY_STATUSES or is_quota_error(error)
+    return isinstance(error, (socket.timeout, ConnectionError))
+
+
+class RequestScheduler:
+
+    def __init__(self, rate_limits=None, project_rate=None, max_concurrency=8, max_retries=6,
+                 base_delay=1.0, max_delay=64.0):
+        """
+        Single path for Google API calls which applies token bucket rate limits per API and per project,
+        retries 429, rate limit 403 and 5xx responses with exponential backoff and jitter, and lowers both the
+        request rate and the number of concurrent calls when quota errors come back
+        :param rate_limits: requests per second per API name, defaults to API_RATE_LIMITS
+        :param project_rate: requests per second shared by all APIs of one project, None for no limit
+        :param max_concurrency: most calls in flight at once per API
+        :param max_retries: retries before the error is raised
+        :param base_delay: seconds before the first retry, doubled on each retry
+        :param max_delay: longest wait between retries
+        """
+        self.rate_limits = dict(API_RATE_LIMITS if rate_limits is None else rate_limits)
+        self.project_rate = project_rate
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._buckets = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, rate):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate)
+            return bucket
+
+    def _limiter(self, api):
+        with self._lock:
+            limiter = self._limiters.get(api)
+            if limiter is None:
+                limiter = self._limiters[api] = AdaptiveLimiter(self.max_concurrency)
+            return limiter
+
+    def _backoff(self, attempt):
+        # full jitter, so retrying threads spread out rather than retrying together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func, api='default', project=None):
+        """
+        Run func, a zero argument callable making one API call, under the limits for api and project
+        :return: whatever func returns
+        """
+        limiter = self._limiter(api)
+        buckets = []
+        if api in self.rate_limits:
+            buckets.append(self._bucket(('api', api), self.rate_limits[api]))
+        if project is not None and self.project_rate:
+            buckets.append(self._bucket(('project', project), self.project_rate))
+
+        for attempt in range(self.max_retries + 1):
+            for bucket in buckets:
+                bucket.acquire()
+
+            limiter.acquire()
+            try:
+                result = func()
+            except Exception as error:
+                quota_error = is_quota_error(error)
+                limiter.release(throttled=quota_error)
+                if quota_error:
+                    count(f'google.{api}.quota_errors')
+                    for bucket in buckets:
+                        bucket.slow_down()
+                if attempt == self.max_retries or not is_retryable(error):
+                    raise
+                delay = self._backoff(attempt)
+                count(f'google.{api}.retries')
+                logger.warning("%s request failed (%s), retry %d of %d in %.1fs",
+                               api, error, attempt + 1, self.max_retries, delay)
+                time.sleep(delay)
+            else:
+                limiter.release()
+                for bucket in buckets:
+                    bucket.speed_up()
+                return result
+
+    def execute(self, request, api='default', project=None):
+        """
+        Execute a googleapiclient request under the limits for api and project
+        :param request: HttpRequest, e.g. service.files().list(...)
+        :return: the response
+        """
+        return self.call(request.execute, api=api, project=project)
+
+
+default_scheduler = RequestScheduler()
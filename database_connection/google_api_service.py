@@ -1,45 +1,125 @@
+import json
 import pickle
 import os
+import threading
+from google.oauth2 import service_account
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
+from .instrumentation import logger
 
+TOKEN_DIR = 'token files'
 
-def create_service_client(client_secret_file, api_name, api_version, scope, prefix=''):
-    CLIENT_SECRET_FILE = client_secret_file
-    API_SERVICE_NAME = api_name
-    API_VERSION = api_version
-    SCOPE = scope
+_credentials = {}
+_credentials_lock = threading.Lock()
+_thread_services = threading.local()
 
-    cred = None
-    working_dir = os.getcwd()
-    token_dir = 'token files'
-    pickle_file = f"token_{API_SERVICE_NAME}_{API_VERSION}{scope.split('/')[-1]}{prefix}.pickle"
 
-    ### Check if token dir exists first, if not, create the folder
-    if not os.path.exists(os.path.join(working_dir, token_dir)):
-        os.mkdir(os.path.join(working_dir, token_dir))
+def get_service_account_credentials(credentials_file, scopes):
+    """
+    Load service account credentials once per file and scopes for the whole process
+    :param credentials_file: service account key file
+    :param scopes: list of scopes
+    :return: google.oauth2.service_account.Credentials
+    """
+    key = (os.path.abspath(credentials_file), tuple(sorted(scopes)))
+    with _credentials_lock:
+        credentials = _credentials.get(key)
+        if credentials is None:
+            credentials = service_account.Credentials.from_service_account_file(credentials_file, scopes=list(scopes))
+            _credentials[key] = credentials
+    return credentials
+
+
+def get_service_account_service(credentials_file, api_name, api_version, scopes):
+    """
+    Return a service built from service account credentials, reusing it for later calls from the same thread.
+    Service objects are not thread safe so each thread gets its own, sharing the credentials.
+    google-api-python-client 2.x builds them from its bundled discovery documents, without a network request
+    :param credentials_file: service account key file
+    :param api_name: e.g. analyticsreporting
+    :param api_version: e.g. v4
+    :param scopes: list of scopes
+    :return: googleapiclient service object
+    """
+    key = (os.path.abspath(credentials_file), tuple(sorted(scopes)), api_name, api_version)
+    services = getattr(_thread_services, 'services', None)
+    if services is None:
+        services = _thread_services.services = {}
+
+    service = services.get(key)
+    if service is None:
+        credentials = get_service_account_credentials(credentials_file, scopes)
+        service = build(api_name, api_version, credentials=credentials)
+        services[key] = service
+    return service
+
+
+def client_project_id(client_secret_file):
+    """
+    Project id from an OAuth client secrets file, used to share rate limits between APIs of one project
+    :return: the project id, or None if the file doesn't have one
+    """
+    try:
+        with open(client_secret_file) as f:
+            client_config = json.load(f)
+    except (OSError, ValueError):
+        return None
+    for client_type in ('installed', 'web'):
+        if client_type in client_config:
+            return client_config[client_type].get('project_id')
+    return None
+
 
-    if os.path.exists(os.path.join(working_dir, token_dir, pickle_file)):
-        with open(os.path.join(working_dir, token_dir, pickle_file), 'rb') as token:
+def clear_service_cache():
+    """ forget cached credentials and this thread's services, e.g. after a key file is replaced """
+    with _credentials_lock:
+        _credentials.clear()
+    _thread_services.services = {}
+
+
+def _token_path(api_name, api_version, scope, prefix=''):
+    return os.path.join(os.getcwd(), TOKEN_DIR, f"token_{api_name}_{api_version}{scope.split('/')[-1]}{prefix}.pickle")
+
+
+def get_client_credentials(client_secret_file, api_name, api_version, scope, prefix=''):
+    """
+    Load the OAuth token saved in the token files folder, refreshing it or running the consent flow
+    when it isn't valid, and save it back. Call it from one thread and share the credentials,
+    as every call reads and may rewrite the same token file
+    :param client_secret_file: OAuth client secrets file
+    :param scope: the one scope requested
+    :param prefix: added to the token file name to keep several tokens for the same api and scope
+    :return: google.oauth2.credentials.Credentials
+    """
+    token_path = _token_path(api_name, api_version, scope, prefix)
+    os.makedirs(os.path.dirname(token_path), exist_ok=True)
+
+    cred = None
+    if os.path.exists(token_path):
+        with open(token_path, 'rb') as token:
             cred = pickle.load(token)
 
     if not cred or not cred.valid:
         if cred and cred.expired and cred.refresh_token:
             cred.refresh(Request())
         else:
-            flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, [SCOPE])
+            flow = InstalledAppFlow.from_client_secrets_file(client_secret_file, [scope])
             cred = flow.run_local_server()
 
-        with open(os.path.join(working_dir, token_dir, pickle_file), 'wb') as token:
+        with open(token_path, 'wb') as token:
             pickle.dump(cred, token)
+    return cred
+
+
+def create_service_client(client_secret_file, api_name, api_version, scope, prefix=''):
+    cred = get_client_credentials(client_secret_file, api_name, api_version, scope, prefix=prefix)
 
     try:
-        service = build(API_SERVICE_NAME, API_VERSION, credentials=cred)
-        print(API_SERVICE_NAME, API_VERSION, 'service created successfully')
+        service = build(api_name, api_version, credentials=cred)
+        logger.info('%s %s service created successfully', api_name, api_version)
         return service
-    except Exception as e:
-        print(e)
-        print(f'Failed to create service instance for {API_SERVICE_NAME}')
-        os.remove(os.path.join(working_dir, token_dir, pickle_file))
+    except Exception:
+        logger.exception('Failed to create service instance for %s', api_name)
+        os.remove(_token_path(api_name, api_version, scope, prefix))
         return None
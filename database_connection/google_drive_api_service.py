@@ -1,17 +1,122 @@
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
-from .google_api_service import create_service_client
+from googleapiclient.http import MediaFileUpload
+from googleapiclient.discovery import build
+from .google_api_service import get_client_credentials, client_project_id
+from .google_api_scheduler import default_scheduler
+from .google_drive_index import DriveMetadataIndex, DEFAULT_MAX_AGE
+from .instrumentation import logger, timed
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
-import json
+import posixpath
+import threading
+import functools
+import hashlib
 import io
+import json
+import mimetypes
+import time
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    feather = None
+    pq = None
+
+LIST_PAGE_SIZE = 1000
+LIST_FIELDS = 'nextPageToken, files(id, name, mimeType, size, md5Checksum, modifiedTime, parents)'
+FILE_FIELDS = 'id, name, mimeType, size, md5Checksum, modifiedTime, parents'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+DOWNLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+MIME_TYPES_FILE = 'mime_types.json'
+GOOGLE_SHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+GOOGLE_APPS_MIME_PREFIX = 'application/vnd.google-apps.'
+READ_FORMATS = {'csv': 'csv', 'txt': 'csv', 'xlsx': 'excel', 'xls': 'excel',
+                'parquet': 'parquet', 'feather': 'feather', 'arrow': 'feather'}
+
+
+@functools.lru_cache(maxsize=1)
+def _mime_table():
+    try:
+        with open(MIME_TYPES_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def resolve_mime_type(file_name):
+    """
+    Mime type for a file name, from mime_types.json in the working directory when it lists the suffix
+    (read once per process), then the mimetypes module, then application/octet-stream
+    """
+    suffix = file_name.split('.')[-1]
+    mime_type = _mime_table().get(suffix)
+    if mime_type is None:
+        mime_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    return mime_type
+
+
+def file_md5(path, block_size=1024 * 1024):
+    """ md5 hex digest of a local file, read in blocks """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class DriveMediaStream(io.RawIOBase):
+
+    def __init__(self, service, gd_file_id, size, chunk_size=DOWNLOAD_CHUNK_SIZE, supports_all_drives=False,
+                 execute=None):
+        """
+        Read only file object over a Drive file, fetching ranged chunks as they are read so the
+        file never has to be held in memory or written to disk as a whole
+        :param execute: callable which executes a request, e.g. GoogleDriveService.execute
+        """
+        self.service = service
+        self.execute = execute or (lambda request: request.execute())
+        self.gd_file_id = gd_file_id
+        self.size = size
+        self.chunk_size = chunk_size
+        self.supports_all_drives = supports_all_drives
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        end = min(self.position + len(buffer), self.position + self.chunk_size, self.size) - 1
+        request = self.service.files().get_media(fileId=self.gd_file_id, supportsAllDrives=self.supports_all_drives)
+        request.headers['Range'] = f'bytes={self.position}-{end}'
+        with timed('drive.download_chunk') as metrics:
+            content = self.execute(request)
+            metrics['bytes'] = len(content or b'')
+        if not content:
+            raise IOError(f"Drive returned no data for {self.gd_file_id} at byte {self.position} of {self.size}")
+        buffer[:len(content)] = content
+        self.position += len(content)
+        return len(content)
 
 
 class GoogleDriveService:
 
-    def __init__(self, client_file, scope, include_shared_drive=False):
+    def __init__(self, client_file, scope, include_shared_drive=False, scheduler=None):
         self.client_file = client_file
         self.scope = scope
+        self.scheduler = scheduler or default_scheduler
+        self.project = client_project_id(client_file)
+        self._credentials = None
         self.service = self.create_service()
         self.include_shared_drive = include_shared_drive
+        self._local = threading.local()
+        self.index = None
 
     def create_service(self):
         api_name = 'drive'
@@ -25,70 +130,386 @@ class GoogleDriveService:
                   ]
         scope_exists = self.scope in scopes
         if scope_exists:
-            return create_service_client(self.client_file, api_name, api_version, self.scope)
+            # loaded once here, worker threads build their services from these credentials
+            self._credentials = get_client_credentials(self.client_file, api_name, api_version, self.scope)
+            return self._build_service()
         else:
             raise ValueError(
                 'Please choose a scope from the list at https://developers.google.com/drive/api/v3/reference/permissions/list')
 
-    def ls(self, folder_id):
-        query = f"parents = '{folder_id}'"
-        results = self.service.files().list(pageSize=10,
-                                            fields="nextPageToken, files(id, name)",
-                                            includeItemsFromAllDrives=self.include_shared_drive,
-                                            supportsAllDrives=self.include_shared_drive,
-                                            q=query).execute()
-        items = results.get('files', [])
-        next_page_token = results.get('nextPageToken', False)
-
-        while next_page_token:
-            results = self.service.files().list(pageSize=10,
-                                                fields="nextPageToken, files(id, name)",
-                                                includeItemsFromAllDrives=self.include_shared_drive,
-                                                supportsAllDrives=self.include_shared_drive,
-                                                q=query).execute()
+    def _build_service(self):
+        return build('drive', 'v3', credentials=self._credentials)
+
+    def execute(self, request):
+        """ execute a request through the scheduler, which applies rate limits and retries """
+        return self.scheduler.execute(request, api='drive', project=self.project)
+
+    def _thread_service(self):
+        """
+        service objects are not thread safe, so threads other than the main one each build their own
+        from the credentials loaded by create_service, without touching the token file
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self.service
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._local.service = self._build_service()
+        return service
+
+    def _list_children(self, folder_id, service=None):
+        service = service or self._thread_service()
+        query = f"'{folder_id}' in parents and trashed = false"
+        items = []
+        page_token = None
+
+        while True:
+            with timed('drive.list', pages=1) as metrics:
+                results = self.execute(service.files().list(pageSize=LIST_PAGE_SIZE,
+                                                            fields=LIST_FIELDS,
+                                                            includeItemsFromAllDrives=self.include_shared_drive,
+                                                            supportsAllDrives=self.include_shared_drive,
+                                                            pageToken=page_token,
+                                                            q=query))
+                metrics['items'] = len(results.get('files', []))
             items.extend(results.get('files', []))
-            next_page_token = results.get('nextPageToken', False)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return items
 
+    @staticmethod
+    def _items_to_df(items):
         item_df = pd.DataFrame(items)
+        if 'size' in item_df.columns:
+            item_df['size'] = pd.to_numeric(item_df['size'])
         return item_df
 
-    def download_file(self, gd_file_id, file_out_name):
-        request = self.service.files().get_media(fileId=gd_file_id)
+    def ls(self, folder_id):
+        """
+        List the files and folders directly inside a folder
+        :param folder_id: google drive folder id
+        :return: dataframe with id, name, mimeType, size, md5Checksum, modifiedTime and parents
+        """
+        return self._items_to_df(self._list_children(folder_id))
+
+    def walk(self, folder_id, max_workers=8):
+        """
+        List everything below a folder, crawling the subfolders concurrently
+        :param folder_id: google drive folder id to start from
+        :param max_workers: number of folders listed at once
+        :return: dataframe as ls, with path relative to folder_id and the parent_id each item was found under
+        """
+        items = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+            def submit(parent_id, parent_path):
+                future = executor.submit(lambda: self._list_children(parent_id, self._thread_service()))
+                pending[future] = (parent_id, parent_path)
+
+            pending = {}
+            submit(folder_id, '')
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    parent_id, parent_path = pending.pop(future)
+                    for item in future.result():
+                        item['path'] = posixpath.join(parent_path, item['name'])
+                        item['parent_id'] = parent_id
+                        items.append(item)
+                        if item.get('mimeType') == FOLDER_MIME_TYPE:
+                            submit(item['id'], item['path'])
+        return self._items_to_df(items)
+
+    def enable_index(self, root_folder_id, index_path=None, max_age=DEFAULT_MAX_AGE):
+        """
+        Keep a local metadata index of everything below a folder, built by a full walk the first time
+        and refreshed from the changes API after that. Folders and files created through this service are
+        written to it straight away, changes made elsewhere are read at most max_age seconds later
+        :param root_folder_id: folder the index covers
+        :param index_path: SQLite file, defaults to a file in the token files folder
+        :param max_age: seconds a lookup trusts the index before refreshing it
+        :return: DriveMetadataIndex
+        """
+        self.index = DriveMetadataIndex(self, root_folder_id, index_path=index_path, max_age=max_age)
+        if self.index.is_built:
+            self.index.refresh()
+        else:
+            self.index.build()
+        return self.index
 
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fd=fh, request=request)
+    def find_folder(self, folder_name, parent_folder_id):
+        """
+        Look up a folder by name inside a parent folder, from the index if it covers the parent
+        :return: the folder id, or None if there is no such folder
+        """
+        if self.index is not None and self.index.covers(parent_folder_id):
+            self.index.refresh_if_stale()
+            matches = self.index.find(folder_name, parent_id=parent_folder_id)
+            matches = matches[matches['mimeType'] == FOLDER_MIME_TYPE]
+            return None if matches.empty else matches['id'].iloc[0]
 
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            print(f"Downloading next chunk, progress - {status.progress() * 100}")
+        escaped_name = folder_name.replace('\\', '\\\\').replace("'", "\\'")
+        query = (f"name = '{escaped_name}' and '{parent_folder_id}' in parents "
+                 f"and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false")
+        service = self._thread_service()
+        results = self.execute(service.files().list(fields='files(id)',
+                                                    includeItemsFromAllDrives=self.include_shared_drive,
+                                                    supportsAllDrives=self.include_shared_drive,
+                                                    q=query))
+        folders = results.get('files', [])
+        return folders[0]['id'] if folders else None
+
+    def get_metadata(self, gd_file_id, service=None):
+        service = service or self._thread_service()
+        return self.execute(service.files().get(fileId=gd_file_id,
+                                                fields=FILE_FIELDS,
+                                                supportsAllDrives=self.include_shared_drive))
+
+    def download_file(self, gd_file_id, file_out_name, chunk_size=DOWNLOAD_CHUNK_SIZE, resume=True,
+                      skip_unchanged=True, progress=None, service=None):
+        """
+        Download a file straight to disk in ranged chunks. The data is written to file_out_name + '.part'
+        and renamed once complete, so an interrupted download can carry on from where it stopped
+        :param gd_file_id: google drive file id
+        :param file_out_name: local path to write to
+        :param chunk_size: bytes requested per ranged request
+        :param resume: continue from an existing .part file rather than starting again
+        :param skip_unchanged: don't download if file_out_name exists with the same md5 as the Drive file
+        :param progress: optional callback called after each chunk with (bytes_done, total_bytes)
+        :param service: service object to use, worker threads pass their own
+        :return: number of bytes downloaded
+        """
+        service = service or self._thread_service()
+        return self._download(gd_file_id, file_out_name, self.get_metadata(gd_file_id, service=service), service,
+                              chunk_size, resume, skip_unchanged, progress)
+
+    def _download(self, gd_file_id, file_out_name, metadata, service, chunk_size, resume, skip_unchanged, progress):
+        if metadata.get('mimeType', '').startswith(GOOGLE_APPS_MIME_PREFIX):
+            # Docs, Sheets and folders have no content or size to download, only exports
+            raise ValueError(f"{metadata.get('name')} ({gd_file_id}) is a {metadata['mimeType']} file, "
+                             f"which has no content to download, export it instead")
+        total_size = int(metadata.get('size', 0))
+        md5_checksum = metadata.get('md5Checksum')
+
+        if skip_unchanged and md5_checksum and os.path.exists(file_out_name) \
+                and file_md5(file_out_name) == md5_checksum:
+            return 0
+
+        part_name = file_out_name + '.part'
+        start = os.path.getsize(part_name) if resume and os.path.exists(part_name) else 0
+        if start > total_size:
+            start = 0
+
+        downloaded = 0
+        with open(part_name, 'ab' if start else 'wb') as f:
+            while start < total_size:
+                end = min(start + chunk_size, total_size) - 1
+                request = service.files().get_media(fileId=gd_file_id, supportsAllDrives=self.include_shared_drive)
+                request.headers['Range'] = f'bytes={start}-{end}'
+                with timed('drive.download_chunk') as metrics:
+                    content = self.execute(request)
+                    metrics['bytes'] = len(content or b'')
+                if not content:
+                    raise IOError(f"Drive returned no data for {gd_file_id} at byte {start} of {total_size}")
+                f.write(content)
+                start += len(content)
+                downloaded += len(content)
+                if progress:
+                    progress(start, total_size)
+
+        if md5_checksum and file_md5(part_name) != md5_checksum:
+            os.remove(part_name)
+            raise IOError(f"Checksum of the download of {gd_file_id} does not match Drive, the partial file was removed")
+        os.replace(part_name, file_out_name)
+        return downloaded
+
+    def download_many(self, gd_file_ids, dest_dir, workers=4, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """
+        Download several files into a folder concurrently, named as they are on Drive. Files which share a name
+        get their id added to it, so each is written to its own path
+        :param gd_file_ids: list of google drive file ids, repeats are downloaded once
+        :param dest_dir: local folder, created if missing
+        :param workers: number of files downloaded at once
+        :param chunk_size: bytes requested per ranged request
+        :return: dataframe of id, path, bytes downloaded and seconds per file
+        """
+        os.makedirs(dest_dir, exist_ok=True)
+        gd_file_ids = list(dict.fromkeys(gd_file_ids))
+
+        def download(item):
+            gd_file_id, metadata, path = item
+            start = time.perf_counter()
+            n_bytes = self._download(gd_file_id, path, metadata, self._thread_service(), chunk_size,
+                                     resume=True, skip_unchanged=True, progress=None)
+            return {'id': gd_file_id, 'path': path, 'bytes': n_bytes, 'seconds': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # the names are needed up front to give files with the same name different paths
+            metadatas = list(executor.map(lambda gd_file_id: self.get_metadata(gd_file_id,
+                                                                               service=self._thread_service()),
+                                          gd_file_ids))
+            name_counts = Counter(metadata['name'] for metadata in metadatas)
+            items = []
+            for gd_file_id, metadata in zip(gd_file_ids, metadatas):
+                name = metadata['name']
+                if name_counts[name] > 1:
+                    stem, extension = os.path.splitext(name)
+                    name = f'{stem}_{gd_file_id}{extension}'
+                items.append((gd_file_id, metadata, os.path.join(dest_dir, name)))
+            results = pd.DataFrame(list(executor.map(download, items)),
+                                   columns=['id', 'path', 'bytes', 'seconds'])
+        elapsed = time.perf_counter() - start
+
+        total_mb = results['bytes'].sum() / 1024 ** 2
+        logger.info("Downloaded %.1f MB in %d files, %.1fs, %.1f MB/s",
+                    total_mb, len(results), elapsed, total_mb / max(elapsed, 1e-9))
+        return results
+
+    def read_dataframe(self, gd_file_id, format=None, chunksize=None, chunk_size=DOWNLOAD_CHUNK_SIZE, **read_kwargs):
+        """
+        Read a Drive file straight into pandas without writing it to disk. CSV is streamed and can be
+        iterated in chunks, Parquet and Feather are read into one buffer handed to pyarrow without copying,
+        and Google Sheets are exported to CSV on the fly
+        :param gd_file_id: google drive file id
+        :param format: csv, excel, parquet or feather, inferred from the file name if None
+        :param chunksize: for csv, return an iterator of dataframes of this many rows
+        :param chunk_size: bytes fetched per ranged request
+        :param read_kwargs: passed on to the pandas reader
+        :return: dataframe, or a csv reader iterator if chunksize is given
+        """
+        metadata = self.get_metadata(gd_file_id)
+
+        if metadata['mimeType'] == GOOGLE_SHEET_MIME_TYPE:
+            # exports can't be requested by range, but are capped at 10MB by Drive
+            content = self.execute(self._thread_service().files().export_media(fileId=gd_file_id,
+                                                                                mimeType='text/csv'))
+            return pd.read_csv(io.BytesIO(content), chunksize=chunksize, **read_kwargs)
+
+        if format is None:
+            format = READ_FORMATS.get(metadata['name'].split('.')[-1].lower())
+            if format is None:
+                raise ValueError(f"Can't tell the format of {metadata['name']}, pass format=")
+
+        stream = DriveMediaStream(self._thread_service(), gd_file_id, int(metadata.get('size', 0)),
+                                  chunk_size=chunk_size, supports_all_drives=self.include_shared_drive,
+                                  execute=self.execute)
+
+        if format == 'csv':
+            return pd.read_csv(io.BufferedReader(stream, buffer_size=chunk_size), chunksize=chunksize, **read_kwargs)
+
+        buffer = bytearray(stream.size)
+        view = memoryview(buffer)
+        while stream.position < stream.size:
+            stream.readinto(view[stream.position:])
+
+        if format == 'excel':
+            return pd.read_excel(io.BytesIO(buffer), **read_kwargs)
+        if format in ('parquet', 'feather'):
+            if pa is None:
+                raise ImportError(f"pyarrow is required to read {format} files")
+            reader = pa.BufferReader(pa.py_buffer(buffer))
+            table = pq.read_table(reader) if format == 'parquet' else feather.read_table(reader)
+            return table.to_pandas(**read_kwargs)
+        raise ValueError(f"Unsupported format {format}")
+
+    def upload_file(self, in_file_name, in_file_path, gd_folder_id, chunk_size=UPLOAD_CHUNK_SIZE):
+        """
+        Upload a file into a Drive folder, using a resumable chunked upload for files larger than chunk_size
+        :param in_file_name: file name, also used as the name on Drive
+        :param in_file_path: folder prefix the name is appended to
+        :param gd_folder_id: google drive folder id
+        :param chunk_size: bytes sent per request for resumable uploads
+        :return: id of the new file
+        """
+        return self._upload(in_file_path + in_file_name, in_file_name, gd_folder_id, self._thread_service(),
+                            chunk_size)
+
+    def _upload(self, local_path, name, gd_folder_id, service, chunk_size, existing_id=None):
+        with timed('drive.upload', bytes=os.path.getsize(local_path)):
+            return self._send_upload(local_path, name, gd_folder_id, service, chunk_size, existing_id)
+
+    def _send_upload(self, local_path, name, gd_folder_id, service, chunk_size, existing_id):
+        resumable = os.path.getsize(local_path) > chunk_size
+        media = MediaFileUpload(local_path, mimetype=resolve_mime_type(name),
+                                resumable=resumable, chunksize=chunk_size if resumable else -1)
+
+        if existing_id:
+            request = service.files().update(fileId=existing_id,
+                                             media_body=media,
+                                             supportsAllDrives=self.include_shared_drive,
+                                             fields=FILE_FIELDS)
+        else:
+            request = service.files().create(body={'name': name, 'parents': [gd_folder_id]},
+                                             media_body=media,
+                                             supportsAllDrives=self.include_shared_drive,
+                                             fields=FILE_FIELDS)
+
+        if not resumable:
+            response = self.execute(request)
+        else:
+            response = None
+            while response is None:
+                _, response = self.scheduler.call(request.next_chunk, api='drive', project=self.project)
+        self._record(response)
+        return response['id']
 
-        fh.seek(0)
+    def _record(self, drive_file):
+        """ write a file or folder this service created or updated into the index, if there is one """
+        if self.index is not None:
+            self.index.record(drive_file)
 
-        with open(file_out_name, 'wb') as f:
-            f.write(fh.read())
-            f.close()
+    def upload_directory(self, local_dir, gd_folder_id, workers=4, skip_unchanged=True, chunk_size=UPLOAD_CHUNK_SIZE):
+        """
+        Upload a local folder tree into a Drive folder. Matching subfolders are created first, reusing any
+        that already exist, then the files are uploaded concurrently. A file already on Drive with the same
+        name is skipped if its md5 matches and updated in place otherwise
+        :param local_dir: local folder to upload the contents of
+        :param gd_folder_id: google drive folder id to upload into
+        :param workers: number of files uploaded at once
+        :param skip_unchanged: skip files whose md5 matches the copy on Drive
+        :param chunk_size: bytes sent per request for resumable uploads
+        :return: dataframe of local path, id and status (uploaded, updated or skipped) per file
+        """
+        uploads = []
+        folder_ids = {os.path.abspath(local_dir): gd_folder_id}
+        for dir_path, dir_names, file_names in os.walk(local_dir):
+            folder_id = folder_ids[os.path.abspath(dir_path)]
+            existing = self.ls(folder_id)
+            existing = {} if existing.empty else \
+                {row['name']: row for row in existing.to_dict('records') if row.get('mimeType') != FOLDER_MIME_TYPE}
 
-    def upload_file(self, in_file_name, in_file_path, gd_folder_id):
-        with open('mime_types.json') as f:
-            mime_types = json.load(f)
+            for dir_name in dir_names:
+                child_id = self.find_folder(dir_name, folder_id) or self.create_folder(dir_name, folder_id)
+                folder_ids[os.path.abspath(os.path.join(dir_path, dir_name))] = child_id
 
-        suffix = in_file_name.split('.')[-1]
-        mime_type = mime_types[suffix]
+            for file_name in file_names:
+                uploads.append((os.path.join(dir_path, file_name), file_name, folder_id, existing.get(file_name)))
 
-        file_metadata = {'name': in_file_name,
-                         'parents': [gd_folder_id]}
-        media = MediaFileUpload(in_file_path + in_file_name, mimetype=mime_type)
+        def upload(item):
+            local_path, name, folder_id, existing_file = item
+            if existing_file is not None:
+                if skip_unchanged and existing_file.get('md5Checksum') == file_md5(local_path):
+                    return {'path': local_path, 'id': existing_file['id'], 'status': 'skipped'}
+                file_id = self._upload(local_path, name, folder_id, self._thread_service(), chunk_size,
+                                       existing_id=existing_file['id'])
+                return {'path': local_path, 'id': file_id, 'status': 'updated'}
+            file_id = self._upload(local_path, name, folder_id, self._thread_service(), chunk_size)
+            return {'path': local_path, 'id': file_id, 'status': 'uploaded'}
 
-        self.service.files().create(body=file_metadata,
-                                    media_body=media,
-                                    supportsAllDrives=self.include_shared_drive,
-                                    fields='id').execute()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return pd.DataFrame(list(executor.map(upload, uploads)), columns=['path', 'id', 'status'])
 
     def create_folder(self, folder_to_create, parent_folder_id):
-        mime_type = 'application/vnd.google-apps.folder'
+        """
+        :return: id of the new folder
+        """
+        mime_type = FOLDER_MIME_TYPE
         file_metadata = {'name': folder_to_create,
                          'mimeType': mime_type,
                          'parents': [parent_folder_id]}
-        self.service.files().create(body=file_metadata,
-                                    supportsAllDrives=self.include_shared_drive).execute()
+        service = self._thread_service()
+        folder = self.execute(service.files().create(body=file_metadata,
+                                                     supportsAllDrives=self.include_shared_drive,
+                                                     fields=FILE_FIELDS))
+        self._record(folder)
+        return folder['id']
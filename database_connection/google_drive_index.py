@@ -0,0 +1,238 @@
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from .google_api_service import TOKEN_DIR
+
+CHANGE_FIELDS = ('nextPageToken, newStartPageToken, '
+                 'changes(fileId, removed, file(id, name, mimeType, size, md5Checksum, modifiedTime, parents, trashed))')
+INDEX_COLUMNS = ['id', 'name', 'mimeType', 'size', 'md5Checksum', 'modifiedTime', 'parent_id', 'path']
+# seconds lookups trust the index before reading the changes made elsewhere
+DEFAULT_MAX_AGE = 60
+
+
+class DriveMetadataIndex:
+
+    def __init__(self, drive_service, root_folder_id, index_path=None, max_age=DEFAULT_MAX_AGE):
+        """
+        Local SQLite copy of the metadata for everything below a Drive folder. It is filled by one walk
+        of the folder and then kept up to date from the changes API, so lookups by name, path or parent
+        are answered without an API call
+        :param drive_service: GoogleDriveService
+        :param root_folder_id: folder the index covers
+        :param index_path: SQLite file, defaults to a file in the token files folder
+        :param max_age: seconds after a build or refresh before refresh_if_stale reads the changes API again
+        """
+        self.drive_service = drive_service
+        self.root_folder_id = root_folder_id
+        self.max_age = max_age
+        self._refreshed_at = None
+        if index_path is None:
+            os.makedirs(os.path.join(os.getcwd(), TOKEN_DIR), exist_ok=True)
+            index_path = os.path.join(os.getcwd(), TOKEN_DIR, f'drive_index_{root_folder_id}.sqlite')
+        self.index_path = index_path
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(index_path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                mimeType TEXT,
+                size INTEGER,
+                md5Checksum TEXT,
+                modifiedTime TEXT,
+                parent_id TEXT,
+                path TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_name ON files (name);
+            CREATE INDEX IF NOT EXISTS files_parent ON files (parent_id, name);
+            CREATE INDEX IF NOT EXISTS files_path ON files (path);
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+
+    def _get_state(self, key):
+        row = self._db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    @property
+    def is_built(self):
+        with self._lock:
+            return self._get_state('start_page_token') is not None
+
+    def _start_page_token(self):
+        response = self.drive_service.execute(self.drive_service._thread_service().changes().getStartPageToken(
+            supportsAllDrives=self.drive_service.include_shared_drive))
+        return response['startPageToken']
+
+    def build(self, max_workers=8):
+        """
+        Fill the index from a full walk of the root folder, replacing anything already in it
+        :param max_workers: number of folders listed at once
+        :return: number of items indexed
+        """
+        # take the token first so changes made during the walk are picked up by the next refresh
+        start_page_token = self._start_page_token()
+        item_df = self.drive_service.walk(self.root_folder_id, max_workers=max_workers)
+        index_df = item_df.reindex(columns=INDEX_COLUMNS).astype(object)
+        rows = list(index_df.where(index_df.notnull(), None).itertuples(index=False, name=None))
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM files')
+            self._db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._set_state('start_page_token', start_page_token)
+        self._refreshed_at = time.monotonic()
+        return len(item_df)
+
+    def refresh(self):
+        """
+        Apply the changes made since the index was built or last refreshed
+        :return: number of changes read
+        """
+        with self._lock:
+            page_token = self._get_state('start_page_token')
+        if page_token is None:
+            return self.build()
+
+        changes = []
+        while page_token:
+            response = self.drive_service.execute(self.drive_service._thread_service().changes().list(
+                pageToken=page_token,
+                pageSize=1000,
+                fields=CHANGE_FIELDS,
+                includeRemoved=True,
+                includeItemsFromAllDrives=self.drive_service.include_shared_drive,
+                supportsAllDrives=self.drive_service.include_shared_drive))
+            changes.extend(response.get('changes', []))
+            page_token = response.get('nextPageToken')
+            new_start_page_token = response.get('newStartPageToken')
+
+        with self._lock, self._db:
+            self._apply_changes(changes)
+            self._set_state('start_page_token', new_start_page_token)
+        self._refreshed_at = time.monotonic()
+        return len(changes)
+
+    def refresh_if_stale(self):
+        """
+        Refresh if the index was last built or refreshed more than max_age seconds ago
+        :return: whether a refresh was made
+        """
+        if self._refreshed_at is not None and time.monotonic() - self._refreshed_at <= self.max_age:
+            return False
+        self.refresh()
+        return True
+
+    def record(self, drive_file):
+        """
+        Add or update an item created through this process, so lookups find it without waiting for a refresh.
+        The next refresh reads the same change again, which leaves the row as it is
+        :param drive_file: file resource with at least id, name, mimeType and parents
+        :return: whether the item is inside the indexed folder and was recorded
+        """
+        parent_id = (drive_file.get('parents') or [None])[0]
+        with self._lock, self._db:
+            if parent_id == self.root_folder_id:
+                path = drive_file['name']
+            else:
+                parent = self._db.execute('SELECT path FROM files WHERE id = ?', (parent_id,)).fetchone()
+                if parent is None:
+                    return False
+                path = f"{parent[0]}/{drive_file['name']}"
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (drive_file['id'], drive_file['name'], drive_file.get('mimeType'),
+                              drive_file.get('size'), drive_file.get('md5Checksum'),
+                              drive_file.get('modifiedTime'), parent_id, path))
+        return True
+
+    def _apply_changes(self, changes):
+        """ must be called holding the lock inside a transaction """
+        upserts = {}
+        for change in changes:
+            drive_file = change.get('file') or {}
+            if change.get('removed') or drive_file.get('trashed'):
+                upserts.pop(change['fileId'], None)
+                self._db.execute('DELETE FROM files WHERE id = ?', (change['fileId'],))
+            else:
+                upserts[change['fileId']] = drive_file
+
+        # a new folder and its contents can arrive in any order, keep applying until nothing else moves
+        while upserts:
+            applied = []
+            for file_id, drive_file in upserts.items():
+                parent_id = (drive_file.get('parents') or [None])[0]
+                indexed_parent = parent_id == self.root_folder_id or self._db.execute(
+                    'SELECT 1 FROM files WHERE id = ?', (parent_id,)).fetchone()
+                if not indexed_parent:
+                    continue
+                self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, NULL)',
+                                 (file_id, drive_file.get('name'), drive_file.get('mimeType'),
+                                  drive_file.get('size'), drive_file.get('md5Checksum'),
+                                  drive_file.get('modifiedTime'), parent_id))
+                applied.append(file_id)
+            if not applied:
+                # anything left has moved outside the root folder
+                self._db.executemany('DELETE FROM files WHERE id = ?', [(file_id,) for file_id in upserts])
+                break
+            for file_id in applied:
+                upserts.pop(file_id)
+
+        # drop the contents of removed folders, one level per pass
+        while self._db.execute('''
+                DELETE FROM files WHERE parent_id != ? AND parent_id NOT IN (SELECT id FROM files)
+                ''', (self.root_folder_id,)).rowcount:
+            pass
+        self._rebuild_paths()
+
+    def _rebuild_paths(self):
+        self._db.execute('''
+            WITH RECURSIVE tree (id, path) AS (
+                SELECT id, name FROM files WHERE parent_id = ?
+                UNION ALL
+                SELECT files.id, tree.path || '/' || files.name FROM files JOIN tree ON files.parent_id = tree.id
+            )
+            UPDATE files SET path = (SELECT tree.path FROM tree WHERE tree.id = files.id)
+        ''', (self.root_folder_id,))
+
+    def _query_df(self, where, params):
+        with self._lock:
+            return pd.read_sql_query(f'SELECT {", ".join(INDEX_COLUMNS)} FROM files WHERE {where}', self._db,
+                                     params=params)
+
+    def covers(self, folder_id):
+        """ whether the contents of a folder are held in the index """
+        if folder_id == self.root_folder_id:
+            return True
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM files WHERE id = ?', (folder_id,)).fetchone() is not None
+
+    def find(self, name, parent_id=None):
+        """
+        :param name: exact file or folder name
+        :param parent_id: only match items directly inside this folder
+        :return: dataframe of matching items
+        """
+        if parent_id is None:
+            return self._query_df('name = ?', (name,))
+        return self._query_df('name = ? AND parent_id = ?', (name, parent_id))
+
+    def children(self, parent_id):
+        return self._query_df('parent_id = ?', (parent_id,))
+
+    def get_by_path(self, path):
+        """
+        :param path: path relative to the root folder, e.g. reports/2020/file.csv
+        :return: dict of the item's metadata, or None if it is not in the index
+        """
+        item_df = self._query_df('path = ?', (path.strip('/'),))
+        return None if item_df.empty else item_df.iloc[0].to_dict()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,141 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger('database_connection')
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket is everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def export(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'buckets': dict(zip([*self.buckets, float('inf')], self.counts))}
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        """ in process counters and latency histograms, keyed by metric name """
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def export(self):
+        """
+        :return: {'counters': {name: value}, 'histograms': {name: summary}}
+        """
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'histograms': {name: histogram.export() for name, histogram in self._histograms.items()}}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+registry = MetricsRegistry()
+_hooks = []
+
+
+def set_registry(metrics_registry):
+    """
+    Replace the registry metrics are recorded in, None to stop recording
+    :param metrics_registry: MetricsRegistry or None
+    """
+    global registry
+    registry = metrics_registry
+
+
+def add_hook(hook):
+    """
+    Register a callable which is given every finished operation as hook(name, seconds, fields), e.g. to
+    forward them to another metrics system. fields holds the counts recorded, such as rows or bytes.
+    Exceptions raised by a hook are logged and otherwise ignored
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def export_metrics():
+    """
+    :return: the current registry's counters and histograms, see MetricsRegistry.export
+    """
+    return registry.export() if registry is not None else {'counters': {}, 'histograms': {}}
+
+
+def count(name, value=1):
+    """ add to a counter, e.g. count('query_cache.hits') """
+    if registry is not None:
+        registry.increment(name, value)
+
+
+@contextlib.contextmanager
+def timed(name, **fields):
+    """
+    Time an operation. The yielded dict can be filled with counts, e.g. fields['rows'] = len(rows), which are
+    added to {name}.{field} counters. The latency goes to the {name}.seconds histogram and failures
+    are counted in {name}.errors
+    :param name: operation name, e.g. sql.run_sql
+    :param fields: initial fields, also included in the log message
+    """
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException:
+        count(f'{name}.errors')
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        if registry is not None:
+            registry.increment(f'{name}.calls')
+            registry.observe(f'{name}.seconds', seconds)
+            for field, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    registry.increment(f'{name}.{field}', value)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s took %.3fs %s', name, seconds, fields)
+        for hook in _hooks:
+            # a failing hook must not fail or hide the outcome of the operation being measured
+            try:
+                hook(name, seconds, fields)
+            except Exception:
+                logger.exception('Metrics hook %r failed for %s', hook, name)
@@ -0,0 +1,298 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+import uuid
+
+import pyodbc
+
+from .instrumentation import count
+from .sql_connection import run_sql, row_to_df
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+    feather = None
+
+INDEX_FILE = 'index.json'
+TABLE_PATTERN = re.compile(r'\b(?:from|join|into|update)\s+((?:\[[^\]]+\]|[\w#]+)(?:\s*\.\s*(?:\[[^\]]+\]|[\w#]+))*)',
+                           re.IGNORECASE)
+
+
+def normalize_query(query):
+    """ collapse whitespace so formatting differences in the sql text share a cache entry """
+    return ' '.join(query.split())
+
+
+def _table_name(name):
+    """ last part of a possibly qualified and bracketed table name, lower case """
+    return name.split('.')[-1].strip().strip('[]').lower()
+
+
+def tables_in_query(query):
+    """
+    Find the table names a query reads from or writes to
+    :param query: sql text
+    :return: set of lower case table names without database/schema qualifiers
+    """
+    return {_table_name(match) for match in TABLE_PATTERN.findall(query)}
+
+
+def connection_namespace(connection):
+    """
+    Server and current database of a pyodbc connection, so the same sql run against
+    different databases gets different cache entries
+    :return: 'server/database'
+    """
+    return f'{connection.getinfo(pyodbc.SQL_SERVER_NAME)}/{connection.getinfo(pyodbc.SQL_DATABASE_NAME)}'
+
+
+class QueryCache:
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3, default_ttl=3600):
+        """
+        Store query results on disk so repeated queries are served without touching the database.
+        Results are written as Feather files when pyarrow is installed, which are read back memory mapped,
+        and pickled otherwise. Files are written under a temporary name and renamed into place, so a
+        reader never sees a partly written result
+        :param cache_dir: folder holding the cached results, created if missing
+        :param max_bytes: total size of cached files before the least recently used are removed
+        :param default_ttl: seconds a result stays valid when no ttl is given, None to never expire
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._lock = threading.RLock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = self._load_index()
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, INDEX_FILE)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = self._index_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path())
+
+    @staticmethod
+    def make_key(query, params=None, namespace=None):
+        """
+        Key for a query and its parameters
+        :param query: sql text, whitespace is normalised
+        :param params: any json serialisable parameters used with the query
+        :param namespace: where the query runs, e.g. from connection_namespace
+        :return: hex digest
+        """
+        payload = json.dumps([namespace, normalize_query(query), params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _remove(self, key):
+        entry = self._index.pop(key, None)
+        if entry:
+            try:
+                os.remove(os.path.join(self.cache_dir, entry['file']))
+            except OSError:
+                pass
+
+    def get(self, key, as_arrow=False):
+        """
+        Load a cached result
+        :param key: from make_key
+        :param as_arrow: return a pyarrow Table, which for a Feather entry is the memory mapped file itself,
+        so a large result isn't copied into memory. table.to_pandas(split_blocks=True) then gives a dataframe
+        sharing the mapped memory where the column types allow, with read-only columns
+        :return: dataframe or Table, or None if there is no valid entry
+        """
+        if as_arrow and pa is None:
+            raise ImportError("pyarrow is required for as_arrow=True")
+
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            if entry['expires'] is not None and entry['expires'] < time.time():
+                self._remove(key)
+                self._save_index()
+                return None
+            entry['last_access'] = time.time()
+            path = os.path.join(self.cache_dir, entry['file'])
+            try:
+                # opened under the lock, so a put replacing the file afterwards doesn't change what is read
+                source = pa.memory_map(path) if entry['format'] == 'feather' else open(path, 'rb')
+            except (OSError, AttributeError):
+                source = None
+
+        try:
+            if source is None:
+                raise OSError(f"{path} is missing")
+            if entry['format'] == 'feather':
+                table = feather.read_table(source, memory_map=True)
+                return table if as_arrow else table.to_pandas()
+            with source:
+                df = pickle.load(source)
+            return pa.Table.from_pandas(df, preserve_index=False) if as_arrow else df
+        except (OSError, EOFError, pickle.UnpicklingError, TypeError, AttributeError, ValueError):
+            with self._lock:
+                # unless a put has replaced the entry in the meantime
+                if self._index.get(key) is entry:
+                    self._remove(key)
+                    self._save_index()
+            return None
+
+    def _write(self, file_name, write):
+        """
+        write(path) to a temporary file next to file_name, removed again if writing fails
+        :return: the temporary path, for os.replace into file_name once written
+        """
+        tmp_path = os.path.join(self.cache_dir, f'{file_name}.{uuid.uuid4().hex}.tmp')
+        try:
+            write(tmp_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return tmp_path
+
+    def put(self, key, df, ttl=None, tables=None):
+        """
+        Store a result
+        :param key: from make_key
+        :param df: dataframe to cache
+        :param ttl: seconds the entry is valid, default_ttl if None
+        :param tables: table names the result depends on, used by invalidate_table
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        tmp_path = None
+
+        if feather is not None:
+            file_format = 'feather'
+            file_name = f'{key}.feather'
+            try:
+                table = pa.Table.from_pandas(df)
+                # one chunk per column, so a memory mapped read can be handed to pandas without a copy
+                tmp_path = self._write(file_name, lambda path: feather.write_feather(
+                    table, path, compression='uncompressed', chunksize=max(table.num_rows, 1)))
+            except (pa.ArrowException, ValueError, TypeError):
+                tmp_path = None
+
+        if tmp_path is None:
+            file_format = 'pickle'
+            file_name = f'{key}.pkl'
+
+            def write_pickle(path):
+                with open(path, 'wb') as f:
+                    pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            tmp_path = self._write(file_name, write_pickle)
+
+        now = time.time()
+        with self._lock:
+            old_entry = self._index.get(key)
+            if old_entry and old_entry['file'] != file_name:
+                self._remove(key)
+            os.replace(tmp_path, os.path.join(self.cache_dir, file_name))
+            self._index[key] = {'file': file_name,
+                                'format': file_format,
+                                'size': os.path.getsize(os.path.join(self.cache_dir, file_name)),
+                                'created': now,
+                                'last_access': now,
+                                'expires': None if ttl is None else now + ttl,
+                                'tables': sorted({_table_name(table) for table in tables or []})}
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        """ remove expired entries, then least recently used ones until under max_bytes """
+        now = time.time()
+        for key in [key for key, entry in self._index.items()
+                    if entry['expires'] is not None and entry['expires'] < now]:
+            self._remove(key)
+
+        total = sum(entry['size'] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]['last_access']):
+            if total <= self.max_bytes:
+                break
+            total -= self._index[key]['size']
+            self._remove(key)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+            self._save_index()
+
+    def invalidate_table(self, table_name):
+        """
+        Remove every cached result which depends on a table, e.g. after it has been reloaded
+        :param table_name: table name, database and schema qualifiers are ignored
+        :return: number of entries removed
+        """
+        table_name = _table_name(table_name)
+        with self._lock:
+            keys = [key for key, entry in self._index.items() if table_name in entry['tables']]
+            for key in keys:
+                self._remove(key)
+            self._save_index()
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+            self._save_index()
+
+    def run_sql(self, cursor, query=None, sql_loc=None, sql_vars=None, ttl=None, tables=None, refresh=False,
+                namespace=None, as_arrow=False):
+        """
+        Cached version of sql_connection.run_sql followed by row_to_df
+        :param cursor: the cursor object for the database connection from get connection
+        :param query: a string query for direct execution
+        :param sql_loc: location of the sql file
+        :param sql_vars: variables to add into the sql file text {}
+        :param ttl: seconds the result is valid, default_ttl if None
+        :param tables: tables the result depends on, found from the query text if None
+        :param refresh: ignore any cached result and re-run the query
+        :param namespace: keeps results from different databases apart, the cursor's server and database if None
+        :param as_arrow: return a pyarrow Table, memory mapped without a copy on a hit, see get
+        :return: dataframe, or Table if as_arrow
+        """
+        if query and type(query) != str:
+            raise TypeError("The entered query must be in a string format")
+        if as_arrow and pa is None:
+            raise ImportError("pyarrow is required for as_arrow=True")
+
+        if not query:
+            with open(sql_loc) as sql_file:
+                query = sql_file.read()
+            if sql_vars:
+                query = query.format(**sql_vars)
+
+        if namespace is None:
+            namespace = connection_namespace(cursor.connection)
+        key = self.make_key(query, namespace=namespace)
+        if not refresh:
+            result = self.get(key, as_arrow=as_arrow)
+            if result is not None:
+                count('query_cache.hits')
+                return result
+
+        count('query_cache.misses')
+        cursor, rows = run_sql(cursor, query=query)
+        df = row_to_df(rows, cursor)
+        self.put(key, df, ttl=ttl, tables=tables_in_query(query) if tables is None else tables)
+        return pa.Table.from_pandas(df, preserve_index=False) if as_arrow else df
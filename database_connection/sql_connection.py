@@ -1,7 +1,57 @@
+import bz2
 import configparser
+import datetime
+import decimal
+import functools
+import gzip
+import lzma
+import os
+import time
+import uuid
 import pyodbc
+import numpy as np
 import pandas as pd
 
+from .instrumentation import timed
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+BULK_INSERT_BATCH_SIZE = 10000
+FETCH_CHUNK_SIZE = 50000
+CATEGORY_THRESHOLD = 0.5
+# largest parameter sizes SQL Server accepts before the MAX types are needed
+MAX_NVARCHAR_SIZE = 4000
+MAX_VARBINARY_SIZE = 8000
+CSV_OPENERS = {None: open, 'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+# types written to parquet as they are, other column types are written as strings
+ARROW_NATIVE_TYPES = (bool, int, float, decimal.Decimal, str, bytes, bytearray,
+                      datetime.datetime, datetime.date, datetime.time)
+
+
+@functools.lru_cache(maxsize=32)
+def _read_config(config_path, modified_time):
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    return config
+
+
+def read_config(config_path):
+    """
+    Parse the configuration file, reusing the parsed result until the file changes on disk
+    :param config_path: path for the configuration file which contains the connection information
+    :return: configparser.ConfigParser
+    """
+    try:
+        modified_time = os.path.getmtime(config_path)
+    except OSError:
+        modified_time = None
+    return _read_config(config_path, modified_time)
+
 
 def get_connection(config_path, config_section='DEFAULT', use_database=False):
     """
@@ -11,8 +61,7 @@ def get_connection(config_path, config_section='DEFAULT', use_database=False):
     :param use_database: connect using the database name
     :return:
     """
-    config = configparser.ConfigParser()
-    config.read(config_path)
+    config = read_config(config_path)
 
     server = config[config_section]['host']
     username = config[config_section]['user']
@@ -73,10 +122,52 @@ def run_sql(cursor,
         if sql_vars:
             query = query.format(**sql_vars)
 
-    cursor.execute(query)
+    with timed('sql.run_sql') as metrics:
+        cursor.execute(query)
+        if fetch_results:
+            rows = cursor.fetchall()
+            metrics['rows'] = len(rows)
+            return cursor, rows
+
 
-    if fetch_results:
-        return cursor, cursor.fetchall()
+def iter_sql(cursor,
+             query=None,
+             sql_loc=None,
+             sql_vars=None,
+             chunk_size=FETCH_CHUNK_SIZE,
+             typed=False):
+    """
+    Run a query and stream the results back as dataframes of at most chunk_size rows,
+    so only one chunk of the result set is held in memory at a time
+    :param cursor: the cursor object for the database connection from get connection
+    :param query: a string query for direct execution
+    :param sql_loc: location of the sql file
+    :param sql_vars: variables to add into the sql file text {}
+    :param chunk_size: number of rows fetched with each cursor.fetchmany call
+    :param typed: build each chunk with the column types from cursor.description, see typed_row_to_df.
+    Every chunk gets the same dtype for a column, but a categorical column's categories are those present in
+    its chunk, so combine them with pd.api.types.union_categoricals rather than pd.concat, which gives object
+    :return: generator of pandas dataframes
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+
+    run_sql(cursor, query=query, sql_loc=sql_loc, sql_vars=sql_vars, fetch_results=False)
+    description = cursor.description
+    columns = [d[0] for d in description]
+
+    dtypes = None
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        if typed:
+            # the dtypes are fixed from the first chunk, so a column never changes kind between chunks
+            if dtypes is None:
+                dtypes = _column_dtypes(description, rows, CATEGORY_THRESHOLD)
+            yield _typed_frame(rows, description, CATEGORY_THRESHOLD, dtypes)
+        else:
+            yield pd.DataFrame.from_records(rows, columns=columns)
 
 
 def run_sql_text_query(query, cursor, commit_change=False, connection=None):
@@ -104,7 +195,201 @@ def row_to_df(rows, cursor):
     :param cursor: cursor object
     :return:
     """
-    return pd.DataFrame.from_records(rows, columns=[d[0] for d in cursor.description])
+    with timed('sql.row_to_df', rows=len(rows)):
+        return pd.DataFrame.from_records(rows, columns=[d[0] for d in cursor.description])
+
+
+def _column_dtypes(description, rows, category_threshold):
+    """
+    Pick each result column's dtype from the type the driver reports, so every chunk of a result set
+    gets the same dtypes. Nullable columns use pandas' nullable Int64/boolean types, and string columns
+    become categoricals when the sample rows have a unique/total ratio at or below category_threshold
+    :param description: cursor.description
+    :param rows: sample rows, e.g. the first chunk, used only to decide on categoricals
+    :param category_threshold: unique/total ratio at or below which strings become categoricals
+    :return: list with one dtype name per column
+    """
+    dtypes = []
+    for position, d in enumerate(description):
+        type_code, precision, scale, null_ok = d[1], d[4] or 0, d[5], d[6]
+        if type_code is bool:
+            dtype = 'boolean' if null_ok else 'bool'
+        # whole number decimals only fit in int64 up to 18 digits of precision
+        elif type_code is int or (type_code is decimal.Decimal and scale == 0 and precision <= 18):
+            dtype = 'Int64' if null_ok else 'int64'
+        elif type_code in (float, decimal.Decimal):
+            dtype = 'float64'
+        # microsecond precision covers SQL Server's whole 0001-9999 range, including 9999-12-31 end dates,
+        # where nanoseconds would overflow outside 1677-2262
+        elif type_code in (datetime.datetime, datetime.date):
+            dtype = 'datetime64[us]'
+        elif type_code is str and rows and \
+                len({row[position] for row in rows}) / len(rows) <= category_threshold:
+            dtype = 'category'
+        else:
+            dtype = 'object'
+        dtypes.append(dtype)
+    return dtypes
+
+
+def _typed_column(values, dtype):
+    """
+    Convert one result column in a single call rather than value by value
+    :param values: list of the column values
+    :param dtype: dtype name from _column_dtypes
+    :return: numpy array, pandas extension array, categorical or object Series
+    """
+    if dtype == 'datetime64[us]':
+        # numpy converts datetimes, dates and None (to NaT) without going through nanoseconds
+        return np.array(values, dtype=dtype)
+    if dtype == 'category':
+        return pd.Categorical(values)
+    if dtype in ('Int64', 'boolean'):
+        if None in values:
+            return pd.array(values, dtype=dtype)
+        return pd.array(np.array(values, dtype=np.int64 if dtype == 'Int64' else bool), dtype=dtype)
+    if dtype == 'object':
+        data = np.empty(len(values), dtype=object)
+        data[:] = values
+        # a Series keeps object dtype, where newer pandas would infer a string dtype from a bare array
+        return pd.Series(data, dtype=object, copy=False)
+    # numpy converts None to nan for floats, and there are no nulls in non nullable int and bool columns
+    return np.array(values, dtype=dtype)
+
+
+def _typed_frame(rows, description, category_threshold, dtypes=None):
+    """
+    :param dtypes: dtypes from _column_dtypes, worked out from these rows if None
+    """
+    columns = [d[0] for d in description]
+    if not rows:
+        return pd.DataFrame(columns=columns)
+
+    if dtypes is None:
+        dtypes = _column_dtypes(description, rows, category_threshold)
+    # one list per column, cheaper than transposing the rows with zip(*rows)
+    data = {name: _typed_column([row[position] for row in rows], dtype)
+            for position, (name, dtype) in enumerate(zip(columns, dtypes))}
+    return pd.DataFrame(data, columns=columns)
+
+
+def typed_row_to_df(rows, cursor, category_threshold=CATEGORY_THRESHOLD, as_arrow=False):
+    """
+    Convert the rows returned from a query into a dataframe with column types taken from cursor.description
+    rather than inferred by pandas, giving int64/float64/datetime64 columns and categoricals for repeated strings
+    :param rows: returns data from cursor.fetchall in run sql functions
+    :param cursor: cursor object
+    :param category_threshold: string columns with a unique/total ratio at or below this become categoricals
+    :param as_arrow: return a pyarrow Table instead of a dataframe, requires pyarrow
+    :return:
+    """
+    if as_arrow and pa is None:
+        raise ImportError("pyarrow is required for as_arrow=True")
+
+    df = _typed_frame(rows, cursor.description, category_threshold)
+    if as_arrow:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    return df
+
+
+def _arrow_schema(description):
+    """ arrow schema for a result set, taken from cursor.description so every chunk is written with the same types """
+    fields = []
+    for d in description:
+        type_code, precision, scale = d[1], d[4] or 0, d[5]
+        if type_code is bool:
+            arrow_type = pa.bool_()
+        elif type_code is int or (type_code is decimal.Decimal and scale == 0 and precision <= 18):
+            arrow_type = pa.int64()
+        elif type_code in (float, decimal.Decimal):
+            arrow_type = pa.float64()
+        elif type_code in (datetime.datetime, datetime.date):
+            arrow_type = pa.timestamp('us')
+        elif type_code is datetime.time:
+            arrow_type = pa.time64('us')
+        elif type_code in (bytes, bytearray):
+            arrow_type = pa.binary()
+        else:
+            # str, and anything else such as uuid.UUID which is written as its text, see _stringify_columns
+            arrow_type = pa.string()
+        fields.append(pa.field(d[0], arrow_type))
+    return pa.schema(fields)
+
+
+def _stringify_columns(df, description):
+    """ convert columns of types arrow has no mapping for, e.g. uuid.UUID, to their str form """
+    for d in description:
+        if d[1] not in ARROW_NATIVE_TYPES:
+            df[d[0]] = pd.Series([None if value is None else str(value) for value in df[d[0]]],
+                                 dtype=object, index=df.index)
+    return df
+
+
+def export_query(cursor,
+                 query,
+                 path,
+                 format='parquet',
+                 chunk_size=FETCH_CHUNK_SIZE,
+                 compression=None,
+                 progress=None):
+    """
+    Stream the results of a query into a file one fetchmany chunk at a time, so memory use
+    does not grow with the size of the result set
+    :param cursor: the cursor object for the database connection from get connection
+    :param query: a string query for direct execution
+    :param path: file to write, overwritten if it exists
+    :param format: 'parquet' (requires pyarrow) or 'csv'
+    :param chunk_size: number of rows fetched and written at a time, one parquet row group per chunk
+    :param compression: parquet codec (default snappy) or csv compression, one of gzip, bz2, xz
+    :param progress: optional callback called after each chunk with (rows_written, rows_per_second)
+    :return: number of rows written
+    """
+    if format not in ('parquet', 'csv'):
+        raise ValueError("format must be 'parquet' or 'csv'")
+    if format == 'parquet' and pq is None:
+        raise ImportError("pyarrow is required to export to parquet")
+    if format == 'csv' and compression not in CSV_OPENERS:
+        raise ValueError(f"csv compression must be one of {list(CSV_OPENERS)}")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+
+    run_sql(cursor, query=query, fetch_results=False)
+    description = cursor.description
+    columns = [d[0] for d in description]
+    rows_written = 0
+    start = time.perf_counter()
+
+    if format == 'parquet':
+        schema = _arrow_schema(description)
+        writer = pq.ParquetWriter(path, schema, compression=compression or 'snappy')
+    else:
+        writer = CSV_OPENERS[compression](path, 'wt', newline='')
+
+    try:
+        if format == 'csv':
+            pd.DataFrame(columns=columns).to_csv(writer, index=False)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            if format == 'parquet':
+                df = _stringify_columns(_typed_frame(rows, description, category_threshold=0), description)
+                writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+            else:
+                pd.DataFrame.from_records(rows, columns=columns).to_csv(writer, header=False, index=False)
+            rows_written += len(rows)
+            if progress:
+                progress(rows_written, rows_written / max(time.perf_counter() - start, 1e-9))
+    except BaseException:
+        # don't leave a partly written file behind
+        writer.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    writer.close()
+    return rows_written
 
 
 def drop_table(connection, cursor, database_name, table_name):
@@ -161,3 +446,206 @@ def turn_data_into_insert(dataframe: pd.DataFrame, table_name: str, database_nam
                     VALUES
                             {data_string}"""
     return insert_query
+
+
+def _dataframe_input_sizes(dataframe: pd.DataFrame):
+    """
+    Map the dataframe dtypes onto pyodbc parameter types so fast_executemany can bind whole batches
+    :param dataframe: the data to be inserted
+    :return: list of (sql_type, column_size, decimal_digits) tuples for cursor.setinputsizes
+    """
+    input_sizes = []
+    for _, series in dataframe.items():
+        if pd.api.types.is_bool_dtype(series):
+            input_sizes.append((pyodbc.SQL_BIT, 0, 0))
+        elif pd.api.types.is_integer_dtype(series):
+            input_sizes.append((pyodbc.SQL_BIGINT, 0, 0))
+        elif pd.api.types.is_float_dtype(series):
+            input_sizes.append((pyodbc.SQL_DOUBLE, 0, 0))
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            input_sizes.append((pyodbc.SQL_TYPE_TIMESTAMP, 27, 7))
+        else:
+            values = series.dropna()
+            if len(values) and values.map(lambda value: isinstance(value, (bytes, bytearray))).all():
+                # bytes sent as WVARCHAR can't be implicitly converted to a VARBINARY column
+                sql_type, limit = pyodbc.SQL_VARBINARY, MAX_VARBINARY_SIZE
+                max_length = int(values.map(len).max())
+            else:
+                sql_type, limit = pyodbc.SQL_WVARCHAR, MAX_NVARCHAR_SIZE
+                max_length = int(values.astype(str).str.len().max()) if len(values) else 1
+            # longer values are bound as (MAX), size 0, as SQL Server rejects larger declared sizes
+            input_sizes.append((sql_type, max(max_length, 1) if max_length <= limit else 0, 0))
+    return input_sizes
+
+
+def _dataframe_to_params(dataframe: pd.DataFrame):
+    """
+    Turn a dataframe into a list of parameter tuples, with missing values sent as NULL
+    :param dataframe: the data to be inserted
+    :return: list of tuples of python objects
+    """
+    values = dataframe.astype(object)
+    values = values.where(pd.notnull(values), None)
+    return list(values.itertuples(index=False, name=None))
+
+
+def bulk_insert(connection, dataframe: pd.DataFrame, database_name: str, table_name: str,
+                columns: list = None, batch_size: int = BULK_INSERT_BATCH_SIZE):
+    """
+    Insert a dataframe using parameterised, batched executemany rather than a built INSERT string.
+    dataframe columns MUST match the columns in the table if columns=None,
+    otherwise specify the table columns in the order they are in the df
+    :param connection: pyodbc connection object, committed after every batch
+    :param dataframe: the data to insert
+    :param database_name: string for database name
+    :param table_name: string of the table name
+    :param columns: list of table column names matching the dataframe columns
+    :param batch_size: number of rows sent per executemany call
+    :return: the number of rows inserted
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+
+    if not columns:
+        columns = [str(col) for col in dataframe.columns]
+    if len(columns) != len(dataframe.columns):
+        raise ValueError("The number of columns must match the number of dataframe columns")
+
+    cursor = connection.cursor()
+    try:
+        with timed('sql.bulk_insert', rows=len(dataframe)):
+            _insert_batches(connection, cursor, f'[{database_name}].[dbo].[{table_name}]', columns, dataframe,
+                            batch_size)
+    finally:
+        cursor.close()
+    return len(dataframe)
+
+
+def _insert_batches(connection, cursor, table_ref, columns, dataframe, batch_size, commit=True):
+    """
+    executemany the dataframe into table_ref in batches of batch_size rows
+    :param table_ref: bracketed table reference, e.g. [database].[dbo].[table] or [#temp]
+    :param commit: commit after every batch, otherwise the caller is responsible for committing
+    """
+    column_string = ', '.join([f'[{col}]' for col in columns])
+    placeholders = ', '.join(['?'] * len(columns))
+    insert_query = f'INSERT INTO {table_ref} ({column_string}) VALUES ({placeholders})'
+
+    cursor.fast_executemany = True
+    cursor.setinputsizes(_dataframe_input_sizes(dataframe))
+    for start in range(0, len(dataframe), batch_size):
+        cursor.executemany(insert_query, _dataframe_to_params(dataframe.iloc[start:start + batch_size]))
+        if commit:
+            connection.commit()
+    cursor.setinputsizes(None)
+
+
+def _stage_dataframe(connection, cursor, dataframe, database_name, table_name, batch_size):
+    """
+    Copy the target table's column types into a session temp table and load the dataframe into it
+    :return: name of the temp table
+    """
+    stage_name = f'#stage_{uuid.uuid4().hex[:12]}'
+    column_string = ', '.join([f'[{col}]' for col in dataframe.columns])
+    table_ref = f'[{database_name}].[dbo].[{table_name}]'
+    # SELECT INTO copies an IDENTITY property, which would reject the key values inserted into the stage.
+    # It isn't copied when the select is a UNION, so union the empty select with itself
+    cursor.execute(f'SELECT TOP 0 {column_string} INTO [{stage_name}] FROM {table_ref} '
+                   f'UNION ALL SELECT TOP 0 {column_string} FROM {table_ref}')
+    _insert_batches(connection, cursor, f'[{stage_name}]', list(dataframe.columns), dataframe, batch_size,
+                    commit=False)
+    return stage_name
+
+
+def _run_staged(connection, dataframe, database_name, table_name, batch_size, build_statement):
+    """
+    Load dataframe into a temp table, run the statement built from its name and return the affected row count
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+
+    cursor = connection.cursor()
+    try:
+        stage_name = _stage_dataframe(connection, cursor, dataframe, database_name, table_name, batch_size)
+        cursor.execute(build_statement(stage_name))
+        row_count = cursor.rowcount
+        cursor.execute(f'DROP TABLE [{stage_name}]')
+        connection.commit()
+        return row_count
+    except pyodbc.Error:
+        # the temp table was created inside the transaction, so the rollback removes it too
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def delete_by_keys(connection, df_keys: pd.DataFrame, database_name: str, table_name: str,
+                   batch_size: int = BULK_INSERT_BATCH_SIZE):
+    """
+    Delete every row whose key columns match a row of df_keys, using one set based DELETE ... JOIN
+    against a temp table instead of a literal IN list
+    :param connection: pyodbc connection object
+    :param df_keys: dataframe of keys, the column names must match columns in the table
+    :param database_name: string for database name
+    :param table_name: string of the table name
+    :param batch_size: number of key rows sent per executemany call when loading the temp table
+    :return: number of rows deleted
+    """
+    if df_keys.empty:
+        return 0
+
+    df_keys = df_keys.drop_duplicates()
+    join_string = ' AND '.join([f't.[{col}] = k.[{col}]' for col in df_keys.columns])
+
+    def build_statement(stage_name):
+        return (f'DELETE t FROM [{database_name}].[dbo].[{table_name}] AS t '
+                f'INNER JOIN [{stage_name}] AS k ON {join_string}')
+
+    return _run_staged(connection, df_keys, database_name, table_name, batch_size, build_statement)
+
+
+def upsert_dataframe(connection, df: pd.DataFrame, key_columns: list, database_name: str, table_name: str,
+                     batch_size: int = BULK_INSERT_BATCH_SIZE):
+    """
+    Insert new rows and update changed rows of a table from a dataframe with a single MERGE.
+    Rows which already match the dataframe are left untouched
+    :param connection: pyodbc connection object
+    :param df: the data, column names must match columns in the table
+    :param key_columns: columns which identify a row, must be unique in df
+    :param database_name: string for database name
+    :param table_name: string of the table name
+    :param batch_size: number of rows sent per executemany call when loading the temp table
+    :return: number of rows inserted or updated
+    """
+    key_columns = list(key_columns)
+    missing = [col for col in key_columns if col not in df.columns]
+    if missing:
+        raise ValueError(f"Key columns {missing} are not in the dataframe")
+    if df.empty:
+        return 0
+    if df.duplicated(subset=key_columns).any():
+        raise ValueError("The key columns must be unique in the dataframe for a MERGE")
+
+    columns = [str(col) for col in df.columns]
+    value_columns = [col for col in columns if col not in key_columns]
+    join_string = ' AND '.join([f't.[{col}] = s.[{col}]' for col in key_columns])
+    insert_columns = ', '.join([f'[{col}]' for col in columns])
+    insert_values = ', '.join([f's.[{col}]' for col in columns])
+
+    update_clause = ''
+    if value_columns:
+        set_string = ', '.join([f't.[{col}] = s.[{col}]' for col in value_columns])
+        source_values = ', '.join([f's.[{col}]' for col in value_columns])
+        target_values = ', '.join([f't.[{col}]' for col in value_columns])
+        # EXCEPT compares NULLs as equal, so only rows with a real difference are updated
+        update_clause = (f'WHEN MATCHED AND EXISTS (SELECT {source_values} EXCEPT SELECT {target_values}) '
+                         f'THEN UPDATE SET {set_string} ')
+
+    def build_statement(stage_name):
+        return (f'MERGE [{database_name}].[dbo].[{table_name}] AS t '
+                f'USING [{stage_name}] AS s ON {join_string} '
+                f'{update_clause}'
+                f'WHEN NOT MATCHED BY TARGET THEN INSERT ({insert_columns}) VALUES ({insert_values});')
+
+    return _run_staged(connection, df, database_name, table_name, batch_size, build_statement)
@@ -0,0 +1,293 @@
+import os
+import re
+import string
+import threading
+from collections import OrderedDict
+
+import pyodbc
+
+IDENTIFIER = re.compile(r'^[\w#]+(\.[\w#]+)*$')
+# text before a variable which puts it where sql only accepts a name or literal, e.g. TOP {n} or FROM {table}
+NAME_POSITION = re.compile(r'(\b(TOP|FROM|JOIN|INTO|UPDATE|TABLE|BY|EXEC|EXECUTE|USE)\s*|[.@])$', re.IGNORECASE)
+IN_LIST_BEFORE = re.compile(r'\bIN\s*\(\s*$', re.IGNORECASE)
+IN_LIST_AFTER = re.compile(r'^\s*\)')
+# closing character of each quoted or commented state of _scan
+CLOSING = {"'": "'", '[': ']', '"': '"', '--': '\n', '/*': '*/'}
+MAX_CACHED_CURSORS = 64
+
+
+class FetchedResult:
+
+    def __init__(self, cursor):
+        """
+        The parts of a cursor callers read after a fetch, so the prepared cursor can be reused
+        by the next run without changing a result the caller still holds
+        """
+        self.description = cursor.description
+        self.rowcount = cursor.rowcount
+
+
+class SqlTemplate:
+
+    def __init__(self, sql_loc, identifiers=None):
+        """
+        A sql file written for str.format, converted so the variables are sent as ? parameters.
+        This keeps the sql text identical between calls so the server can reuse its plan.
+        '{name}' and {name} both become ?, and IN ({name}) takes a list of values, one ? each.
+        Variables listed in identifiers (table or column names, TOP counts, which can not be parameters)
+        are still substituted into the text. Any other variable inside a string literal or in such a
+        position raises ValueError, as it would otherwise give broken sql or silently wrong results
+        :param sql_loc: location of the sql file
+        :param identifiers: names of variables to format into the text rather than parameterise
+        """
+        self.sql_loc = sql_loc
+        self.identifiers = set(identifiers or [])
+        self._mtime = None
+        self._parts = []
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        """
+        Re-read the sql file if it has been modified since it was last loaded
+        :return: True if the file was read
+        """
+        mtime = os.path.getmtime(self.sql_loc)
+        if mtime == self._mtime:
+            return False
+        with open(self.sql_loc) as sql_file:
+            text = sql_file.read()
+        self._parts = self._parse(text, self.identifiers)
+        self._mtime = mtime
+        return True
+
+    @staticmethod
+    def _scan(text, state=None):
+        """
+        Follow text through string literals, quoted names and comments
+        :param state: the open quote or comment at the start of text, None in plain sql
+        :return: (state, start), the state at the end of text and where in text it began, -1 if before text
+        """
+        start = -1
+        i = 0
+        while i < len(text):
+            if state is None:
+                for opening in ('--', '/*', "'", '[', '"'):
+                    if text.startswith(opening, i):
+                        state, start = opening, i
+                        i += len(opening)
+                        break
+                else:
+                    i += 1
+            elif state in ("'", '[', '"') and text.startswith(CLOSING[state] * 2, i):
+                # an escaped '' or ]] inside the quotes
+                i += 2
+            elif text.startswith(CLOSING[state], i):
+                i += len(CLOSING[state])
+                state = None
+            else:
+                i += 1
+        return state, start
+
+    @classmethod
+    def _parse(cls, text, identifiers):
+        """
+        :return: list of (literal_text, field_name, kind) where kind is 'param', 'list' or 'identifier'
+        """
+        fields = []
+        for literal_text, field_name, format_spec, conversion in string.Formatter().parse(text):
+            if field_name is not None and (not field_name.isidentifier() or format_spec or conversion):
+                raise ValueError(f"Only plain named variables are supported in sql templates, found {{{field_name}}}")
+            fields.append([literal_text, field_name])
+
+        parts = []
+        state = None
+        for position, (literal_text, field_name) in enumerate(fields):
+            state, start = cls._scan(literal_text, state)
+            if field_name is None:
+                parts.append((literal_text, None, None))
+                continue
+            following = fields[position + 1][0] if position + 1 < len(fields) else ''
+
+            if state in ('--', '/*'):
+                # str.format would fill it in, but it has no effect on the query
+                parts.append((literal_text + '{' + field_name + '}', None, None))
+                continue
+            if field_name in identifiers:
+                parts.append((literal_text, field_name, 'identifier'))
+                continue
+            if state == "'" and start == len(literal_text) - 1 and following.startswith("'") \
+                    and not following.startswith("''"):
+                # a whole '{name}' or N'{name}' literal, the quotes go and the value is the parameter
+                literal_text = literal_text[:-1]
+                if re.search(r'(^|\W)N$', literal_text, re.IGNORECASE):
+                    literal_text = literal_text[:-1]
+                fields[position + 1][0] = following[1:]
+                state = None
+                parts.append((literal_text, field_name, 'param'))
+            elif state == "'":
+                raise ValueError(f"sql variable {field_name} is inside a string literal, where a parameter "
+                                 f"can't go. Quote the whole value as '{{{field_name}}}' and build it in python, "
+                                 f"e.g. with the % of a LIKE pattern")
+            elif state is not None or NAME_POSITION.search(literal_text) or following.startswith('.'):
+                raise ValueError(f"sql variable {field_name} is in a name or TOP position, where a parameter "
+                                 f"can't go. List it in identifiers to format it into the text")
+            elif IN_LIST_BEFORE.search(literal_text) and IN_LIST_AFTER.match(following):
+                parts.append((literal_text, field_name, 'list'))
+            else:
+                parts.append((literal_text, field_name, 'param'))
+        return parts
+
+    @property
+    def variables(self):
+        return [field_name for _, field_name, _ in self._parts if field_name]
+
+    def render(self, sql_vars=None):
+        """
+        Build the parameterised query
+        :param sql_vars: values for the variables in the file
+        :return: (query, params) ready for cursor.execute(query, params)
+        """
+        sql_vars = sql_vars or {}
+        query_parts = []
+        params = []
+        for literal_text, field_name, kind in self._parts:
+            query_parts.append(literal_text)
+            if field_name is None:
+                continue
+            if field_name not in sql_vars:
+                raise KeyError(f"No value given for sql variable {field_name}")
+            value = sql_vars[field_name]
+            if kind == 'identifier':
+                if not IDENTIFIER.match(str(value)):
+                    raise ValueError(f"{value} is not a valid identifier for sql variable {field_name}")
+                query_parts.append(str(value))
+            elif kind == 'list':
+                if isinstance(value, str):
+                    raise ValueError(f"sql variable {field_name} is an IN list, give its values as a list "
+                                     f"rather than a string")
+                values = list(value) if isinstance(value, (list, tuple, set, frozenset)) else [value]
+                if not values:
+                    raise ValueError(f"sql variable {field_name} is an empty IN list")
+                query_parts.append(', '.join(['?'] * len(values)))
+                params.extend(values)
+            else:
+                query_parts.append('?')
+                params.append(value)
+        return ''.join(query_parts), params
+
+
+class SqlTemplateRegistry:
+
+    def __init__(self, max_cursors=MAX_CACHED_CURSORS):
+        """
+        Cache of SqlTemplate objects by file, and of one cursor per connection and query so that
+        pyodbc re-executes an already prepared statement
+        :param max_cursors: most cursors kept, the least recently used is closed beyond this. Each cursor
+        keeps its connection open, so this also bounds the connections held by the cache
+        """
+        self.max_cursors = max_cursors
+        self._templates = {}
+        self._cursors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sql_loc, identifiers=None):
+        """
+        Load a template once, reloading it only when the file changes
+        :param sql_loc: location of the sql file
+        :param identifiers: names of variables to format into the text rather than parameterise
+        :return: SqlTemplate
+        """
+        key = (os.path.abspath(sql_loc), frozenset(identifiers or []))
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None:
+                template = SqlTemplate(sql_loc, identifiers=identifiers)
+                self._templates[key] = template
+                return template
+        template.reload_if_changed()
+        return template
+
+    @staticmethod
+    def _close_quietly(cursor):
+        try:
+            cursor.close()
+        except pyodbc.Error:
+            pass
+
+    def _prepared_cursor(self, connection, query):
+        # the cached cursor holds a reference to its connection, so the id can't be reused while it is cached
+        key = (id(connection), query)
+        evicted = []
+        with self._lock:
+            cursor = self._cursors.get(key)
+            if cursor is None:
+                cursor = connection.cursor()
+                self._cursors[key] = cursor
+                while len(self._cursors) > self.max_cursors:
+                    evicted.append(self._cursors.popitem(last=False)[1])
+            else:
+                self._cursors.move_to_end(key)
+        for old_cursor in evicted:
+            self._close_quietly(old_cursor)
+        return cursor
+
+    def _forget_cursor(self, connection, query):
+        with self._lock:
+            self._cursors.pop((id(connection), query), None)
+
+    def forget_connection(self, connection):
+        """ close and drop the cursors kept for a connection, e.g. before closing it """
+        with self._lock:
+            keys = [key for key in self._cursors if key[0] == id(connection)]
+            cursors = [self._cursors.pop(key) for key in keys]
+        for cursor in cursors:
+            self._close_quietly(cursor)
+
+    def run(self, connection, sql_loc, sql_vars=None, fetch_results=True, identifiers=None):
+        """
+        Run a sql file with its variables sent as parameters, on a cursor kept for this connection and query
+        :param connection: the pyodbc connection object
+        :param sql_loc: location of the sql file
+        :param sql_vars: values for the variables in the file
+        :param fetch_results: get results using crsr fetchall
+        :param identifiers: names of variables to format into the text rather than parameterise
+        :return: (result, rows) if fetch_results, where result is a FetchedResult with the cursor's description
+        and rowcount, so it can be given to row_to_df as run_sql's cursor would be
+        """
+        query, params = self.get(sql_loc, identifiers=identifiers).render(sql_vars)
+        cursor = self._prepared_cursor(connection, query)
+        try:
+            cursor.execute(query, params)
+        except pyodbc.Error:
+            # don't keep a cursor which may have been closed or left in a bad state
+            self._forget_cursor(connection, query)
+            raise
+
+        if fetch_results:
+            rows = cursor.fetchall()
+            return FetchedResult(cursor), rows
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            cursors = list(self._cursors.values())
+            self._cursors.clear()
+        for cursor in cursors:
+            self._close_quietly(cursor)
+
+
+default_registry = SqlTemplateRegistry()
+
+
+def run_sql_template(connection, sql_loc, sql_vars=None, fetch_results=True, identifiers=None):
+    """
+    Parameterised alternative to run_sql for sql files, using the shared template registry
+    :param connection: the pyodbc connection object
+    :param sql_loc: location of the sql file
+    :param sql_vars: values for the variables in the file
+    :param fetch_results: get results using crsr fetchall
+    :param identifiers: names of variables to format into the text rather than parameterise
+    :return: (result, rows) if fetch_results, see SqlTemplateRegistry.run
+    """
+    return default_registry.run(connection, sql_loc, sql_vars=sql_vars,
+                                fetch_results=fetch_results, identifiers=identifiers)
@@ -18,7 +18,7 @@ setup(name='ADL_connections',
       author='ADL Smartcare',
       license='MIT',
       zip_safe=False,
-      packages=['database_connection'],
+      packages=['database_connection', 'database_connection.aio'],
       setup_requires=[
           'setuptools>=41.0.1',
           'wheel>=0.33.4',